@@ -1,10 +1,33 @@
 #!/usr/bin/env python
 # Copyright (C) 2016 SignalFx, Inc.
 
+import base64
+import cProfile
+import collections
+import fnmatch
+import hashlib
+import heapq
 import json
+import math
+import mmap
+import os
 import pprint
-
-from six.moves import urllib
+import random
+import re
+import socket
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2 has no tracemalloc
+    tracemalloc = None
+
+import six
+from six.moves import BaseHTTPServer, http_client, queue, socketserver, urllib
 
 import collectd
 import metric_info
@@ -26,43 +49,640 @@ REQUEST_TYPE_NODE = "node"
 REQUEST_TYPE_NODE_STAT = "node_stat"
 REQUEST_TYPE_BUCKET = "bucket"
 REQUEST_TYPE_BUCKET_STAT = "bucket_stat"
-
-# These are determined by the plugin config settings and are set by config()
-http_timeout = DEFAULT_API_TIMEOUT
+# Metric groups with their own collection interval, set by Interval<Group>
+GROUP_STORAGE = "Storage"
+GROUP_NODE_STATS = "NodeStats"
+GROUP_BUCKET_BASIC = "BucketBasic"
+GROUP_BUCKET_OPS = "BucketOps"
+TARGET_GROUPS = {
+    TARGET_NODE: (GROUP_STORAGE, GROUP_NODE_STATS),
+    TARGET_BUCKET: (GROUP_BUCKET_BASIC, GROUP_BUCKET_OPS),
+}
+DEFAULT_PROFILE_TOP_ALLOCATIONS = 25  # Allocation sites kept per tracemalloc snapshot
+DEFAULT_OVERRUN_THRESHOLD = 3  # Consecutive overrunning cycles before the interval is stretched
+DEFAULT_MAX_INTERVAL_STRETCH = 8  # Upper bound of the effective interval as a multiple of Interval
+SELF_METRIC_PREFIX = "plugin"
+DEFAULT_BREAKER_THRESHOLD = 3  # Consecutive failed calls before a host's circuit opens
+DEFAULT_BREAKER_MAX_BACKOFF = 300  # Upper bound in seconds between probes of an open circuit
+DEFAULT_FAILOVER_PEERS = 2  # Peers tried, fastest first, when the seed node does not answer
+LATENCY_SMOOTHING = 0.3  # Weight of the newest sample in the moving average of a node's latency
+DEFAULT_HEDGE_PERCENTILE = 95  # Seed latency percentile after which a hedged request is sent
+DEFAULT_HEDGE_MAX_RATIO = 0.5  # Upper bound of hedged requests per eligible call
+HEDGE_MIN_SAMPLES = 10  # Seed latency samples needed before requests are hedged
+HEDGE_WAIT_TIMEOUTS = 2  # Timeouts, for connecting and reading, a hedged call waits for its requests
+LATENCY_SAMPLES = 100  # Seed latency samples kept to derive the hedge delay
+DEFAULT_MAX_CONCURRENT_REQUESTS = 8  # Parallel per-node requests in CollectAllNodes mode
+DEFAULT_ADAPTIVE_LATENCY_THRESHOLD = 2.0  # Average API latency in seconds above which the cluster is under pressure
+DEFAULT_HEARTBEAT_INTERVALS = 10  # Cycles after which an unchanged value is sent again
+MEMBERSHIP_REFRESH_INTERVAL = 300  # Seconds between pools/default fetches made only to learn failover peers
+COUNTER_RATES_RAW = "raw"
+COUNTER_RATES_RATE = "rate"
+COUNTER_RATES_BOTH = "both"
+RATE_SUFFIX = ".rate"  # Appended to the name of a counter to name its per-second rate
+COUNTER_WRAP_WIDTHS = (32, 64)  # Bit widths a collectd COUNTER may wrap around at
+HOT_KEY_METRIC = "bucket.hot_keys.ops"
+DEFAULT_MAX_HOT_KEY_SERIES = 100  # Distinct (node, key) hot key series kept per Module
+DEFAULT_SERIES_IDLE_CYCLES = 10  # Cycles after which a series not sent again leaves the series registry
+DIMENSION_TRANSPORT_PLUGIN_INSTANCE = "plugin_instance"
+DIMENSION_TRANSPORT_META = "meta"
+SERIES_ID_LENGTH = 16  # Hex digits of the dimension hash used as plugin_instance with DimensionTransport meta
+DIMENSION_CACHE_SIZE = 10000  # Dimension sets whose plugin_instance and meta are kept per Module
+OUTPUT_MODE_COLLECTD = "collectd"
+OUTPUT_MODE_HTTP = "http"
+INGEST_COMPRESS_LEVEL = 6  # zlib level of the gzip compressed batches of OutputMode http
+DEFAULT_INGEST_TIMEOUT = 5  # Seconds to wait for the ingest endpoint of OutputMode http
+SPOOL_DROP_OLDEST = "oldest"
+SPOOL_DROP_NEWEST = "newest"
+DEFAULT_SPOOL_MAX_BYTES = 64 * 1024 * 1024  # Upper bound of the spool of failed OutputMode http batches
+DEFAULT_SPOOL_MAX_AGE = 3600  # Seconds after which a spooled batch is dropped instead of replayed
+DEFAULT_SPOOL_REPLAY_BATCHES = 5  # Spooled batches replayed per cycle once the ingest endpoint recovers
+SPOOL_SEGMENT_BYTES = 1024 * 1024  # Size after which a new spool segment file is started
+SPOOL_RECORD_HEADER = struct.Struct("!dI")  # Time spooled and length of each batch in a segment
+PROMETHEUS_PREFIX = "couchbase_"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+PROMETHEUS_STALE_INTERVALS = 2  # Longest group intervals after which an unpublished series leaves the exposition
+HOT_KEY_HASH_LENGTH = 8  # Hex digits of the hash replacing the end of a hot key too long for FieldLength
+
+# Modules whose read callback is registered from init() after their start
+# offset, and the timers doing so
+DEFERRED_READS = []
+STAGGER_TIMERS = []
+
+# Circuit breakers keyed by the base URL of the Couchbase host they guard
+BREAKERS = {}
+BREAKERS_LOCK = threading.Lock()
+
+# Idle keep-alive connections to the ingest endpoints of OutputMode http,
+# keyed by (scheme, host:port)
+INGEST_CONNECTIONS = {}
+INGEST_CONNECTIONS_LOCK = threading.Lock()
+
+# Prometheus exposition servers keyed by (address, port), started from init()
+PROMETHEUS_EXPORTERS = {}
+PROMETHEUS_EXPORTERS_LOCK = threading.Lock()
+
+# Series registry shared by all Modules of the process, created by the first
+# Module setting MaxSeries
+SERIES_REGISTRY = None
+SERIES_REGISTRY_LOCK = threading.Lock()
 
 
 class Metric:
-    def __init__(self, name, value, dimensions=None):
+    def __init__(self, name, value, dimensions=None, metric_type=DEFAULT_METRIC_TYPE):
         self.name = name
         self.value = value
+        self.type = metric_type
         if dimensions is None:
             self.dimensions = {}
         else:
             self.dimensions = dimensions
 
     def __str__(self):
-        return "Metric { name: %s, value: %s, dimensions: %s}" % (self.name, self.value, self.dimensions)
+        return "Metric { name: %s, type: %s, value: %s, dimensions: %s}" % (
+            self.name,
+            self.type,
+            self.value,
+            self.dimensions,
+        )
+
+
+class LeaderElection:
+    """
+    Decides whether this collector is responsible for cluster-wide metrics.
+    The leader is the node whose hostname sorts first; with sharding, each
+    unit of work is owned by its rendezvous hash winner instead. Results are
+    cached and only recomputed when the cluster membership or the identity
+    of this node changes.
+    """
+
+    def __init__(self):
+        self.membership = None
+        self.this_node = None
+        self.leader = None
+        self.is_leader = False
+        self.owners = {}
+
+    def update(self, nodes_obj, fallback_nodes=()):
+        """
+        Updates the election from a pools/default response and returns True
+        if this node is the leader.
+        """
+        this_node, nodes_list = _sorted_nodes_list(nodes_obj)
+        if this_node is None:
+            this_node = next((node for node in fallback_nodes if node in nodes_list), None)
+        membership = (this_node, tuple(nodes_list))
+        if membership == self.membership:
+            return self.is_leader
+
+        self.membership = membership
+        self.this_node = this_node
+        self.leader = nodes_list[0] if nodes_list else None
+        self.is_leader = this_node is not None and this_node == self.leader
+        self.owners = {}
+        if this_node is None:
+            collectd.warning("Unable to identify this node among %s, not emitting cluster-wide metrics" % nodes_list)
+        else:
+            collectd.info("Cluster leader is %s, this node is %s" % (self.leader, this_node))
+        return self.is_leader
+
+    def owns(self, key):
+        """
+        Returns True if this node owns the unit of cluster-wide work
+        identified by key.
+        """
+        if self.this_node is None:
+            return False
+        owner = self.owners.get(key)
+        if owner is None:
+            owner = self.owners[key] = _rendezvous_owner(key, self.membership[1])
+        return owner == self.this_node
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for the calls to one Couchbase host. After threshold
+    consecutive failures the circuit opens and calls are refused without
+    touching the network. Once the backoff has elapsed a single probe call is
+    let through: success closes the circuit, failure doubles the backoff up
+    to max_backoff.
+    """
+
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+    def __init__(self, threshold, backoff, max_backoff):
+        self.threshold = threshold
+        self.base_backoff = backoff
+        self.max_backoff = max(backoff, max_backoff)
+        self.state = self.CLOSED
+        self.failures = 0
+        self.backoff = backoff
+        self.next_probe = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self, now=None):
+        if self.threshold <= 0:
+            return True
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and (now or time.time()) >= self.next_probe:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                collectd.info("Circuit closed again after %d failed calls" % self.failures)
+            self.state = self.CLOSED
+            self.failures = 0
+            self.backoff = self.base_backoff
+
+    def record_failure(self, now=None):
+        """
+        Records a failed call and returns True if the failure should be
+        logged as an error, i.e. while the circuit was still closed.
+        """
+        if self.threshold <= 0:
+            return True
+        with self.lock:
+            self.failures += 1
+            was_closed = self.state == self.CLOSED
+            if self.state == self.HALF_OPEN:
+                self.backoff = min(self.backoff * 2, self.max_backoff)
+            elif not was_closed or self.failures < self.threshold:
+                return was_closed
+            self.state = self.OPEN
+            self.next_probe = (now or time.time()) + self.backoff
+            collectd.warning(
+                "Circuit open after %d failed calls, next probe in %ss" % (self.failures, self.backoff)
+            )
+            return was_closed
 
 
-def _api_call(url, opener):
+class SeriesRegistry:
+    """
+    Bounds the number of distinct series sent by the process. Series are
+    tracked by the hash of their metric name and plugin_instance, in least
+    recently sent order with the time after which they count as idle. Idle
+    series are evicted from the front, and once max_series series are
+    tracked, values of new series are dropped.
+    """
+
+    def __init__(self, max_series, idle_cycles):
+        self.max_series = max_series
+        self.idle_cycles = idle_cycles
+        self.series = collections.OrderedDict()
+        self.dropped = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    def admit(self, metric_name, plugin_instance, now, interval):
+        """
+        Records a value of a series sent by a Module with the given interval
+        and returns False if it must be dropped.
+        """
+        series = hash((metric_name, plugin_instance))
+        with self.lock:
+            self._evict_idle(now)
+            if self.series.pop(series, None) is None and len(self.series) >= self.max_series:
+                self.dropped += 1
+                return False
+            self.series[series] = now + self.idle_cycles * interval
+            return True
+
+    def _evict_idle(self, now):
+        while self.series:
+            series, idle_after = next(iter(self.series.items()))
+            if idle_after > now:
+                return
+            del self.series[series]
+            self.evicted += 1
+
+
+def _get_series_registry(max_series, idle_cycles):
+    """
+    Returns the series registry of the process, creating it with the given
+    settings if this is the first module setting MaxSeries.
+    """
+    global SERIES_REGISTRY
+    with SERIES_REGISTRY_LOCK:
+        if SERIES_REGISTRY is None:
+            SERIES_REGISTRY = SeriesRegistry(max_series, idle_cycles)
+        return SERIES_REGISTRY
+
+
+class Spool:
+    """
+    Bounded on-disk queue of batches OutputMode http could not send. Batches
+    are appended to numbered segment files and replayed oldest first, a few
+    per cycle, once the ingest endpoint answers again. Segments are read
+    through mmap where possible and removed once replayed. The offset up to
+    which a partly replayed segment was consumed is kept in a sidecar file,
+    so a restart does not send those batches again. When the spool is full,
+    either its oldest segment or the new batch is dropped.
+    """
+
+    def __init__(self, directory, max_bytes, max_age, drop_policy, replay_batches):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.drop_policy = drop_policy
+        self.replay_batches = replay_batches
+        self.segments = []
+        self.sequence = 0
+        self.dropped = 0
+        self.expired = 0
+        self.replayed = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Segments left by a previous run are replayed as well
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".spool") and name[: -len(".spool")].isdigit():
+                self.segments.append(self._scan(os.path.join(directory, name)))
+                self.sequence = max(self.sequence, int(name[: -len(".spool")]))
+
+    @property
+    def size(self):
+        return sum(segment["size"] - segment["offset"] for segment in self.segments)
+
+    @property
+    def pending(self):
+        return sum(segment["pending"] for segment in self.segments)
+
+    def append(self, body, now):
+        """
+        Spools a batch and returns False if it was dropped instead.
+        """
+        self._expire(now)
+        record_size = SPOOL_RECORD_HEADER.size + len(body)
+        if record_size > self.max_bytes:
+            self.dropped += 1
+            return False
+        while self.size + record_size > self.max_bytes:
+            if self.drop_policy == SPOOL_DROP_NEWEST:
+                self.dropped += 1
+                return False
+            segment = self.segments.pop(0)
+            self.dropped += segment["pending"]
+            _remove_segment(segment)
+
+        if not self.segments or self.segments[-1]["size"] + record_size > SPOOL_SEGMENT_BYTES:
+            self.sequence += 1
+            path = os.path.join(self.directory, "%020d.spool" % self.sequence)
+            self.segments.append({"path": path, "size": 0, "offset": 0, "pending": 0, "newest": now})
+        segment = self.segments[-1]
+        with open(segment["path"], "ab") as f:
+            f.write(SPOOL_RECORD_HEADER.pack(now, len(body)) + body)
+        segment["size"] += record_size
+        segment["pending"] += 1
+        segment["newest"] = now
+        return True
+
+    def replay(self, send, now):
+        """
+        Passes up to replay_batches spooled batches, oldest first, to send and
+        stops at the first one send returns False for. Returns the number of
+        batches sent.
+        """
+        self._expire(now)
+        sent = 0
+        while self.segments and sent < self.replay_batches:
+            segment = self.segments[0]
+            consumed = segment["offset"]
+            with open(segment["path"], "rb") as f:
+                data = _map_file(f)
+                try:
+                    while segment["offset"] < segment["size"] and sent < self.replay_batches:
+                        spooled, length = SPOOL_RECORD_HEADER.unpack_from(data, segment["offset"])
+                        start = segment["offset"] + SPOOL_RECORD_HEADER.size
+                        if spooled >= now - self.max_age:
+                            if not send(bytes(data[start:start + length])):
+                                return sent
+                            sent += 1
+                            self.replayed += 1
+                        else:
+                            self.expired += 1
+                        segment["offset"] = start + length
+                        segment["pending"] -= 1
+                finally:
+                    if isinstance(data, mmap.mmap):
+                        data.close()
+                    if consumed < segment["offset"] < segment["size"]:
+                        _save_offset(segment)
+            if segment["offset"] < segment["size"]:
+                break
+            self.segments.pop(0)
+            _remove_segment(segment)
+        return sent
+
+    def _expire(self, now):
+        while self.segments and self.segments[0]["newest"] < now - self.max_age:
+            segment = self.segments.pop(0)
+            self.expired += segment["pending"]
+            _remove_segment(segment)
+
+    def _scan(self, path):
+        """
+        Reads the records of a segment file, cutting off a last record that
+        was only partly written, and skips the records already replayed.
+        """
+        size = pending = 0
+        newest = 0.0
+        consumed = _load_offset(path)
+        offset = 0
+        with open(path, "rb") as f:
+            data = _map_file(f)
+            try:
+                while size + SPOOL_RECORD_HEADER.size <= len(data):
+                    spooled, length = SPOOL_RECORD_HEADER.unpack_from(data, size)
+                    if size + SPOOL_RECORD_HEADER.size + length > len(data):
+                        break
+                    if size == consumed:
+                        offset, pending = size, 0
+                    size += SPOOL_RECORD_HEADER.size + length
+                    pending += 1
+                    newest = spooled
+                if size == consumed:
+                    offset, pending = size, 0
+                truncated = size < len(data)
+            finally:
+                if isinstance(data, mmap.mmap):
+                    data.close()
+        if truncated:
+            collectd.warning("Cutting off a partly written batch of spool segment %s" % path)
+            with open(path, "r+b") as f:
+                f.truncate(size)
+        return {"path": path, "size": size, "offset": offset, "pending": pending, "newest": newest}
+
+
+def _load_offset(path):
     """
-    Makes a REST call against the Couchbase API.
+    Returns the offset up to which a spool segment was replayed by a previous
+    run, or 0 if it was not or the sidecar file is unreadable.
+    """
+    try:
+        with open(path + ".offset") as f:
+            return int(f.read())
+    except (EnvironmentError, ValueError):
+        return 0
+
+
+def _save_offset(segment):
+    """
+    Writes the replay offset of a spool segment to its sidecar file, through
+    a rename so a crash never leaves a partly written offset behind.
+    """
+    temporary = segment["path"] + ".offset.tmp"
+    try:
+        with open(temporary, "w") as f:
+            f.write(str(segment["offset"]))
+        os.rename(temporary, segment["path"] + ".offset")
+    except EnvironmentError as e:
+        collectd.warning("Unable to save the replay offset of %s: %s" % (segment["path"], e))
+
+
+def _remove_segment(segment):
+    _remove_file(segment["path"])
+    if os.path.exists(segment["path"] + ".offset"):
+        _remove_file(segment["path"] + ".offset")
+
+
+def _map_file(f):
+    """
+    Returns the content of an open file as a read-only mmap, or as bytes
+    where it cannot be mapped, e.g. when it is empty.
+    """
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        return f.read()
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        collectd.warning("Unable to remove %s: %s" % (path, e))
+
+
+class PrometheusExporter:
+    """
+    Serves the latest snapshot of every Module publishing to it in the
+    Prometheus text format. The text is rendered once per published snapshot,
+    so scrapes only copy a cached buffer and never reach Couchbase.
+    """
+
+    def __init__(self, address, port):
+        self.address = address
+        self.port = port
+        self.snapshots = collections.OrderedDict()
+        self.text = b""
+        self.lock = threading.Lock()
+        self.server = None
+
+    def publish(self, source, samples, stale_after, now=None):
+        """
+        Adds the samples of the last cycle of a Module, a list of (metric name,
+        collectd type, dimensions, value), to its snapshot. A series keeps its
+        last sample until it was not published for stale_after seconds, so
+        metric groups fetched less often than every cycle stay visible.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            snapshot = self.snapshots.setdefault(source, collections.OrderedDict())
+            for sample in samples:
+                snapshot[(sample[0], frozenset(sample[2].items()))] = (sample, now + stale_after)
+            for series, (_, stale_at) in list(snapshot.items()):
+                if stale_at <= now:
+                    del snapshot[series]
+            self.text = _render_prometheus(
+                [sample for sample, _ in snapshot.values()] for snapshot in self.snapshots.values()
+            )
+
+    def start(self):
+        exporter = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = exporter.text
+                self.send_response(200)
+                self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                collectd.debug("Prometheus endpoint: " + format % args)
+
+        class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server((self.address, self.port), Handler)
+        collectd.info("Serving Prometheus metrics on %s:%d" % self.server.server_address[:2])
+        _start_daemon_thread(self.server.serve_forever)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def _get_prometheus_exporter(address, port):
+    with PROMETHEUS_EXPORTERS_LOCK:
+        exporter = PROMETHEUS_EXPORTERS.get((address, port))
+        if exporter is None:
+            exporter = PROMETHEUS_EXPORTERS[(address, port)] = PrometheusExporter(address, port)
+        return exporter
+
+
+def _render_prometheus(snapshots):
+    """
+    Renders snapshots in the Prometheus text format, with the samples of
+    each metric name grouped under one TYPE line.
+    """
+    families = collections.OrderedDict()
+    for samples in snapshots:
+        for name, metric_type, dimensions, value in samples:
+            name = PROMETHEUS_PREFIX + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+            if name not in families:
+                families[name] = ("gauge" if metric_type == DEFAULT_METRIC_TYPE else "counter", [])
+            labels = ",".join(
+                '%s="%s"' % (re.sub(r"[^a-zA-Z0-9_]", "_", key), _escape_label_value(val))
+                for key, val in sorted(dimensions.items())
+                if val is not None
+            )
+            families[name][1].append("%s{%s} %s" % (name, labels, _format_sample_value(value)))
+    lines = []
+    for name, (metric_type, samples) in families.items():
+        lines.append("# TYPE %s %s" % (name, metric_type))
+        lines.extend(samples)
+    return ("\n".join(lines) + "\n").encode("utf-8") if lines else b""
+
+
+def _escape_label_value(value):
+    return six.text_type(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_sample_value(value):
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+def _get_breaker(base_url, threshold=DEFAULT_BREAKER_THRESHOLD, backoff=DEFAULT_INTERVAL,
+                 max_backoff=DEFAULT_BREAKER_MAX_BACKOFF):
+    """
+    Returns the circuit breaker of a Couchbase host, creating it with the
+    given settings if this is the first module talking to the host.
+    """
+    with BREAKERS_LOCK:
+        breaker = BREAKERS.get(base_url)
+        if breaker is None:
+            breaker = BREAKERS[base_url] = CircuitBreaker(threshold, backoff, max_backoff)
+        return breaker
+
+
+def _base_url_of(url):
+    parts = urllib.parse.urlsplit(url)
+    return "%s://%s" % (parts.scheme, parts.netloc)
+
+
+def _api_call(url, opener, timeout=DEFAULT_API_TIMEOUT):
+    """
+    Makes a REST call against the Couchbase API. Calls to a host whose
+    circuit breaker is open are refused without a request. The module's
+    opener is used directly rather than installed globally, so modules with
+    different credentials can call concurrently.
     Args:
     url (str): The URL to get, including endpoint
+    opener (OpenerDirector): The module's opener, holding its credentials
+    timeout (float): Seconds to wait for the response
     Returns:
     list: The JSON response
     """
+    breaker = BREAKERS.get(_base_url_of(url))
+    if breaker is not None and not breaker.allow():
+        collectd.debug("Circuit open, skipping API call %s" % url)
+        return None
+    result = None
     try:
-        urllib.request.install_opener(opener)
-        resp = urllib.request.urlopen(url, timeout=http_timeout)
-    except (urllib.error.HTTPError, urllib.error.URLError) as e:
+        resp = opener.open(url, timeout=timeout)
+        result = json.load(resp)
+    except urllib.error.HTTPError as e:
+        # Only server errors say the host is unhealthy, a 4xx such as an
+        # unknown bucket or bad credentials is a problem of the one Module
+        if e.code >= 500:
+            _record_api_failure(breaker, "Error making API call (%s) %s" % (e, url))
+            return None
         collectd.error("Error making API call (%s) %s" % (e, url))
+    except (urllib.error.URLError, http_client.HTTPException, socket.error) as e:
+        _record_api_failure(breaker, "Error making API call (%s) %s" % (e, url))
         return None
-    try:
-        return json.load(resp)
     except ValueError as e:
         collectd.error("Error parsing JSON for API call (%s) %s" % (e, url))
-        return None
+    # The host answered, so its circuit stays or becomes closed
+    if breaker is not None:
+        breaker.record_success()
+    return result
+
+
+def _record_api_failure(breaker, msg):
+    if breaker is None or breaker.record_failure():
+        collectd.error(msg)
+    else:
+        collectd.debug(msg)
 
 
 def config(config_values, testing="no"):
@@ -80,9 +700,53 @@ def config(config_values, testing="no"):
     username = None
     password = None
     api_urls = {}
+    http_timeout = DEFAULT_API_TIMEOUT
     field_length = DEFAULT_FIELD_LENGTH
     cluster_name = CLUSTER_DEFAULT
     extra_dimensions = ""
+    profile_cycles = 0
+    profile_output = None
+    profile_tracemalloc = False
+    profile_trigger_file = None
+    overrun_threshold = DEFAULT_OVERRUN_THRESHOLD
+    max_interval_stretch = DEFAULT_MAX_INTERVAL_STRETCH
+    stagger_start = False
+    start_jitter = 0.0
+    breaker_threshold = DEFAULT_BREAKER_THRESHOLD
+    breaker_max_backoff = DEFAULT_BREAKER_MAX_BACKOFF
+    failover_peers = DEFAULT_FAILOVER_PEERS
+    hedge_requests = False
+    hedge_percentile = DEFAULT_HEDGE_PERCENTILE
+    hedge_max_ratio = DEFAULT_HEDGE_MAX_RATIO
+    collect_all_nodes = False
+    shard_cluster_work = False
+    max_concurrent_requests = DEFAULT_MAX_CONCURRENT_REQUESTS
+    group_intervals = {}
+    adaptive_polling = False
+    suppress_unchanged = False
+    heartbeat_intervals = DEFAULT_HEARTBEAT_INTERVALS
+    counter_rates = COUNTER_RATES_RAW
+    derived_metrics = False
+    dimension_transport = DIMENSION_TRANSPORT_PLUGIN_INSTANCE
+    output_mode = OUTPUT_MODE_COLLECTD
+    prometheus_port = 0
+    prometheus_address = ""
+    ingest_url = None
+    ingest_user = None
+    ingest_password = None
+    ingest_timeout = DEFAULT_INGEST_TIMEOUT
+    spool_directory = None
+    spool_max_bytes = DEFAULT_SPOOL_MAX_BYTES
+    spool_max_age = DEFAULT_SPOOL_MAX_AGE
+    spool_drop_policy = SPOOL_DROP_OLDEST
+    spool_replay_batches = DEFAULT_SPOOL_REPLAY_BATCHES
+    max_series = 0
+    series_idle_cycles = DEFAULT_SERIES_IDLE_CYCLES
+    hot_keys = 0
+    max_hot_key_series = DEFAULT_MAX_HOT_KEY_SERIES
+    include_patterns = []
+    exclude_patterns = []
+    adaptive_latency_threshold = DEFAULT_ADAPTIVE_LATENCY_THRESHOLD
 
     required_keys = ("CollectTarget", "Host", "Port")
     opt_keys = ("Interval", "CollectMode", "ClusterName", "Dimensions")
@@ -103,12 +767,102 @@ def config(config_values, testing="no"):
             username = val.values[0]
         elif val.key in bucket_specific_keys and val.key == "Password" and val.values[0]:
             password = val.values[0]
+        elif val.key == "Timeout" and val.values[0]:
+            http_timeout = float(val.values[0])
         elif val.key == "FieldLength" and val.values[0]:
             field_length = int(val.values[0])
         elif val.key in opt_keys and val.key == "ClusterName" and val.values[0]:
             cluster_name = val.values[0]
         elif val.key in opt_keys and val.key == "Dimensions" and val.values[0]:
             extra_dimensions = val.values[0]
+        # Read profiling parameters
+        elif val.key == "ProfileCycles" and val.values[0]:
+            profile_cycles = int(val.values[0])
+        elif val.key == "ProfileOutput" and val.values[0]:
+            profile_output = val.values[0]
+        elif val.key == "ProfileTracemalloc":
+            profile_tracemalloc = _str_to_bool(val.values[0])
+        elif val.key == "ProfileTriggerFile" and val.values[0]:
+            profile_trigger_file = val.values[0]
+        # Read scheduling parameters
+        elif val.key == "OverrunThreshold" and val.values[0]:
+            overrun_threshold = int(val.values[0])
+        elif val.key == "MaxIntervalStretch" and val.values[0]:
+            max_interval_stretch = int(val.values[0])
+        elif val.key == "StaggerStart":
+            stagger_start = _str_to_bool(val.values[0])
+        elif val.key == "StartJitter" and val.values[0]:
+            start_jitter = float(val.values[0])
+        elif val.key == "CircuitBreakerThreshold" and val.values[0] is not None:
+            breaker_threshold = int(val.values[0])
+        elif val.key == "CircuitBreakerMaxBackoff" and val.values[0]:
+            breaker_max_backoff = float(val.values[0])
+        elif val.key == "FailoverPeers" and val.values[0] is not None:
+            failover_peers = int(val.values[0])
+        elif val.key == "HedgeRequests":
+            hedge_requests = _str_to_bool(val.values[0])
+        elif val.key == "HedgePercentile" and val.values[0]:
+            hedge_percentile = float(val.values[0])
+        elif val.key == "HedgeMaxRatio" and val.values[0] is not None:
+            hedge_max_ratio = float(val.values[0])
+        elif val.key == "CollectAllNodes":
+            collect_all_nodes = _str_to_bool(val.values[0])
+        elif val.key == "ShardClusterWork":
+            shard_cluster_work = _str_to_bool(val.values[0])
+        elif val.key == "MaxConcurrentRequests" and val.values[0]:
+            max_concurrent_requests = int(val.values[0])
+        elif val.key == "SuppressUnchanged":
+            suppress_unchanged = _str_to_bool(val.values[0])
+        elif val.key == "HeartbeatIntervals" and val.values[0]:
+            heartbeat_intervals = int(val.values[0])
+        elif val.key == "CounterRates" and val.values[0]:
+            counter_rates = str(val.values[0]).lower()
+        elif val.key == "PrometheusPort" and val.values[0]:
+            prometheus_port = int(val.values[0])
+        elif val.key == "PrometheusAddress" and val.values[0]:
+            prometheus_address = val.values[0]
+        elif val.key == "OutputMode" and val.values[0]:
+            output_mode = str(val.values[0]).lower()
+        elif val.key == "IngestURL" and val.values[0]:
+            ingest_url = val.values[0]
+        elif val.key == "IngestUser" and val.values[0]:
+            ingest_user = val.values[0]
+        elif val.key == "IngestPassword" and val.values[0]:
+            ingest_password = val.values[0]
+        elif val.key == "IngestTimeout" and val.values[0]:
+            ingest_timeout = float(val.values[0])
+        elif val.key == "SpoolDirectory" and val.values[0]:
+            spool_directory = val.values[0]
+        elif val.key == "SpoolMaxBytes" and val.values[0]:
+            spool_max_bytes = int(val.values[0])
+        elif val.key == "SpoolMaxAge" and val.values[0]:
+            spool_max_age = float(val.values[0])
+        elif val.key == "SpoolDropPolicy" and val.values[0]:
+            spool_drop_policy = str(val.values[0]).lower()
+        elif val.key == "SpoolReplayBatches" and val.values[0]:
+            spool_replay_batches = int(val.values[0])
+        elif val.key == "DimensionTransport" and val.values[0]:
+            dimension_transport = str(val.values[0]).lower()
+        elif val.key == "MaxSeries" and val.values[0]:
+            max_series = int(val.values[0])
+        elif val.key == "SeriesIdleCycles" and val.values[0]:
+            series_idle_cycles = int(val.values[0])
+        elif val.key == "HotKeys" and val.values[0]:
+            hot_keys = int(val.values[0])
+        elif val.key == "MaxHotKeySeries" and val.values[0]:
+            max_hot_key_series = int(val.values[0])
+        elif val.key == "IncludeMetric" and val.values:
+            include_patterns.extend(str(value) for value in val.values)
+        elif val.key == "ExcludeMetric" and val.values:
+            exclude_patterns.extend(str(value) for value in val.values)
+        elif val.key == "DerivedMetrics":
+            derived_metrics = _str_to_bool(val.values[0])
+        elif val.key == "AdaptivePolling":
+            adaptive_polling = _str_to_bool(val.values[0])
+        elif val.key == "AdaptiveLatencyThreshold" and val.values[0]:
+            adaptive_latency_threshold = float(val.values[0])
+        elif val.key.startswith("Interval") and val.key[len("Interval"):] and val.values[0]:
+            group_intervals[val.key[len("Interval"):]] = float(val.values[0])
 
     # Make sure all required config settings are present, and log them
     collectd.info("Using config settings:")
@@ -128,6 +882,37 @@ def config(config_values, testing="no"):
     else:
         raise ValueError("Invalid CollectTarget parameter")
 
+    if output_mode not in (OUTPUT_MODE_COLLECTD, OUTPUT_MODE_HTTP):
+        raise ValueError("Invalid OutputMode parameter: %s" % output_mode)
+    if output_mode == OUTPUT_MODE_HTTP and not ingest_url:
+        raise ValueError("Missing required config setting for OutputMode http: IngestURL")
+    if spool_directory and output_mode != OUTPUT_MODE_HTTP:
+        raise ValueError("SpoolDirectory requires OutputMode http")
+    if spool_drop_policy not in (SPOOL_DROP_OLDEST, SPOOL_DROP_NEWEST):
+        raise ValueError("Invalid SpoolDropPolicy parameter: %s" % spool_drop_policy)
+    if dimension_transport not in (DIMENSION_TRANSPORT_PLUGIN_INSTANCE, DIMENSION_TRANSPORT_META):
+        raise ValueError("Invalid DimensionTransport parameter: %s" % dimension_transport)
+    if counter_rates not in (COUNTER_RATES_RAW, COUNTER_RATES_RATE, COUNTER_RATES_BOTH):
+        raise ValueError("Invalid CounterRates parameter: %s" % counter_rates)
+    if counter_rates != COUNTER_RATES_RAW and not any(
+        spec.type != metric_info.GAUGE for spec in metric_info.registry.values()
+    ):
+        raise ValueError(
+            "CounterRates %s has no effect, no metric is registered as a counter in metric_info.metric_types"
+            % counter_rates
+        )
+
+    # Each metric group of the target is fetched at its own interval, and the
+    # read callback runs at the shortest of them
+    groups = TARGET_GROUPS[plugin_config["CollectTarget"]]
+    unknown_groups = set(group_intervals) - set(groups)
+    if unknown_groups:
+        raise ValueError("Invalid interval settings for %s: %s" % (plugin_config["CollectTarget"], unknown_groups))
+    group_schedule = dict(
+        (group, {"interval": group_intervals.get(group, float(interval)), "next_due": 0.0}) for group in groups
+    )
+    read_interval = min([float(interval)] + [group["interval"] for group in group_schedule.values()])
+
     # Populate the API URLs now that we have the config
     base_url = "http://%s:%s" % (plugin_config["Host"], plugin_config["Port"])
 
@@ -146,42 +931,248 @@ def config(config_values, testing="no"):
     module_config = {
         "plugin_config": plugin_config,
         "interval": interval,
+        "read_interval": read_interval,
+        "group_schedule": group_schedule,
         "collect_mode": collect_mode,
         "collect_bucket": collect_bucket,
         "username": username,
         "password": password,
         "opener": opener,
+        "auth": auth,
+        "http_timeout": http_timeout,
+        "counter_lock": threading.Lock(),
         "field_length": field_length,
+        "dimension_transport": dimension_transport,
+        "dimension_cache": {},
         "base_url": base_url,
         "cluster_name": cluster_name,
         "extra_dimensions": extra_dimensions,
+        "collect_all_nodes": collect_all_nodes,
+        "shard_cluster_work": shard_cluster_work,
+        "max_concurrent_requests": max(1, max_concurrent_requests),
+        "adaptive": None,
+        "suppression": None,
+        "counter_rates": None,
+        "derived": None,
+        "metric_filter": None,
+        "hot_keys": None,
+        "series_registry": None,
+        "output": None,
+        "prometheus": None,
     }
 
+    # Samples of the current cycle, published to the exporter at its end
+    if prometheus_port > 0:
+        module_config["prometheus"] = {
+            "exporter": _get_prometheus_exporter(prometheus_address, prometheus_port),
+            "stale_after": PROMETHEUS_STALE_INTERVALS * max(group["interval"] for group in group_schedule.values()),
+            "samples": [],
+        }
+
+    # Values of the current cycle, sent as one batch at its end
+    if output_mode == OUTPUT_MODE_HTTP:
+        module_config["output"] = _build_output(ingest_url, ingest_user, ingest_password, ingest_timeout)
+
+    if max_series > 0:
+        module_config["series_registry"] = _get_series_registry(max_series, max(1, series_idle_cycles))
+
+    # Last dispatched value, number of suppressed repeats and the time after
+    # which the series counts as gone, keyed by (metric name, plugin_instance)
+    # in least recently seen order
+    if suppress_unchanged:
+        heartbeat = max(1, heartbeat_intervals)
+        module_config["suppression"] = {
+            "heartbeat": heartbeat,
+            "idle_after": (heartbeat + 1) * max(group["interval"] for group in group_schedule.values()),
+            "series": collections.OrderedDict(),
+            "suppressed": 0,
+            "evicted": 0,
+        }
+
+    # Previous value and time per counter series, keyed by (metric name,
+    # sorted dimensions), and the last uptime seen per node
+    if counter_rates != COUNTER_RATES_RAW:
+        module_config["counter_rates"] = {
+            "keep_raw": counter_rates == COUNTER_RATES_BOTH,
+            "series": {},
+            "uptimes": {},
+            "resets": 0,
+        }
+
+    # Include and exclude patterns compiled into one regex each, and the
+    # decision per metric name
+    if include_patterns or exclude_patterns:
+        module_config["metric_filter"] = {
+            "include": _compile_metric_patterns(include_patterns),
+            "exclude": _compile_metric_patterns(exclude_patterns),
+            "selected": {},
+        }
+
+    # Hot key series by (node, key) in least recently seen order, with the
+    # time they were last seen
+    if hot_keys > 0:
+        module_config["hot_keys"] = {
+            "top": hot_keys,
+            "max_series": max(hot_keys, max_hot_key_series),
+            "series": collections.OrderedDict(),
+            "lock": threading.Lock(),
+            "evicted": 0,
+            "dropped": 0,
+        }
+
+    # Inputs of the derived metrics kept from the previous cycle, keyed by
+    # sorted dimensions
+    if derived_metrics:
+        module_config["derived"] = {"previous": {}}
+
+    # Adaptive polling backs off while ns_server is slow or rebalancing
+    if adaptive_polling:
+        module_config["adaptive"] = {
+            "latency_threshold": adaptive_latency_threshold,
+            "latency": None,
+            "rebalancing": False,
+            "under_pressure": False,
+        }
+
     # Prepare dimensions list
     module_config["dimensions"] = _build_dimensions(module_config)
 
+    # The unit of cluster-wide work of the Module, as assigned by
+    # ShardClusterWork
+    if plugin_config["CollectTarget"] == TARGET_NODE:
+        module_config["read_func"] = read_node_stats
+        module_config["read_name"] = "node_{0}:{1}".format(plugin_config["Host"], plugin_config["Port"])
+        module_config["cluster_work"] = ("", "pools/default")
+    else:
+        module_config["read_func"] = read_bucket_stats
+        module_config["cluster_work"] = (collect_bucket, "pools/default/buckets")
+        module_config["read_name"] = "bucket_{0}_{1}:{2}".format(
+            collect_bucket, plugin_config["Host"], plugin_config["Port"]
+        )
+
+    # Batches that could not be sent are spooled in a directory of the Module
+    if spool_directory:
+        module_config["output"]["spool"] = Spool(
+            os.path.join(spool_directory, re.sub(r"[^\w.-]", "_", module_config["read_name"])),
+            spool_max_bytes,
+            spool_max_age,
+            spool_drop_policy,
+            max(1, spool_replay_batches),
+        )
+
+    # Profiling is only wired in when asked for, so a plain config keeps the
+    # read callback registered directly with collectd.
+    module_config["profile"] = None
+    if profile_cycles > 0 or profile_trigger_file:
+        module_config["profile"] = {
+            "cycles_left": profile_cycles,
+            "default_cycles": profile_cycles or 1,
+            "output": profile_output or tempfile.gettempdir(),
+            "tracemalloc": profile_tracemalloc and tracemalloc is not None,
+            "trigger_file": profile_trigger_file,
+            "cycle": 0,
+        }
+        collectd.info("Profiling enabled: %s" % module_config["profile"])
+
+    module_config["cycle_state"] = {
+        "lock": threading.Lock(),
+        "next_due": 0.0,
+        "stretch": 1,
+        "overruns": 0,
+        "recoveries": 0,
+        "pressure_stretch": 1,
+        "skipped": 0,
+        "overrun_threshold": overrun_threshold,
+        "max_stretch": max(1, max_interval_stretch),
+    }
+
     collectd.info("Using dimensions:")
     collectd.info(pprint.pformat(module_config["dimensions"]))
 
+    # NODE modules only need the full pools/default document for the
+    # cluster-wide storage totals; per-node metrics come from nodes/self
+    module_config["cluster_stats_wanted"] = any(
+        _is_metric_name_allowed(name, module_config)
+        for name in metric_info.metric_default + metric_info.metric_detailed
+        if name.startswith("storage.")
+    )
+    module_config["leader"] = LeaderElection()
+    module_config["breaker_settings"] = (breaker_threshold, float(interval), breaker_max_backoff)
+    module_config["breaker"] = _get_breaker(base_url, *module_config["breaker_settings"])
+
+    # Cluster membership learned from pools/default, used to fail over to a
+    # peer when the seed node (the configured Host) does not answer
+    module_config["cluster"] = {
+        "this_node": None,
+        "peers": [],
+        "latency": {},
+        "max_peers": failover_peers,
+        "failovers": 0,
+        "refreshed": 0.0,
+        "seed_latencies": collections.deque(maxlen=LATENCY_SAMPLES),
+    }
+
+    # Hedged requests are capped at one per eligible call, so they can never
+    # more than double the load on the cluster
+    module_config["hedge"] = None
+    if hedge_requests:
+        module_config["hedge"] = {
+            "percentile": min(max(hedge_percentile, 0.0), 100.0),
+            "max_ratio": min(max(hedge_max_ratio, 0.0), 1.0),
+            "eligible": 0,
+            "hedged": 0,
+            "wins": 0,
+        }
+
+    module_config["start_offset"] = None
+    if stagger_start or start_jitter > 0:
+        module_config["start_offset"] = _start_offset(
+            module_config["read_name"], read_interval, stagger_start, start_jitter
+        )
+        collectd.info("Starting %s after %.2fs" % (module_config["read_name"], module_config["start_offset"]))
+
     if testing == "yes":
         # for testing purposes
         return module_config
 
     # register read callbacks
-    if plugin_config["CollectTarget"] == TARGET_NODE:
-        collectd.register_read(
-            read_node_stats,
-            interval,
-            data=module_config,
-            name="node_{0}:{1}".format(plugin_config["Host"], plugin_config["Port"]),
-        )
+    if module_config["start_offset"] is None:
+        _register_read(module_config)
     else:
-        collectd.register_read(
-            read_bucket_stats,
-            interval,
-            data=module_config,
-            name="bucket_{0}_{1}:{2}".format(collect_bucket, plugin_config["Host"], plugin_config["Port"]),
-        )
+        # Threads started before collectd daemonizes do not survive the fork,
+        # so staggered modules are registered from init()
+        DEFERRED_READS.append(module_config)
+
+
+def _register_read(module_config):
+    collectd.register_read(
+        read_callback, module_config["read_interval"], data=module_config, name=module_config["read_name"]
+    )
+
+
+def _start_offset(read_name, interval, stagger_start, start_jitter):
+    """
+    Returns the delay before a module's first cycle. Staggered modules get a
+    deterministic phase within the interval hashed from their read name, so
+    many modules spread their requests evenly and keep their phase across
+    restarts. The optional random jitter is added on top.
+    """
+    offset = 0.0
+    if stagger_start:
+        offset = (zlib.crc32(read_name.encode("utf-8")) & 0xFFFFFFFF) / float(0x100000000) * interval
+    if start_jitter > 0:
+        offset += random.uniform(0, start_jitter)
+    return offset
+
+
+def _str_to_bool(value):
+    """
+    Converts a collectd config value to a boolean. Unquoted true/false arrive
+    as booleans, quoted ones as strings.
+    """
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("true", "yes", "on", "1")
 
 
 def _build_dimensions(module_config):
@@ -224,17 +1215,73 @@ def _parse_with_prefix(metric_name_pref, obj, dimensions, module_config):
 
 
 def _is_metric_name_allowed(metric_name, module_config):
-    if metric_name in metric_info.metric_default:
+    return _metric_spec(metric_name, module_config) is not None
+
+
+def _compile_metric_patterns(patterns):
+    """
+    Compiles IncludeMetric or ExcludeMetric patterns into a single regex.
+    Patterns enclosed in slashes are regular expressions, all others are
+    shell-style globs.
+    """
+    if not patterns:
+        return None
+    expressions = []
+    for pattern in patterns:
+        if len(pattern) > 1 and pattern.startswith("/") and pattern.endswith("/"):
+            expressions.append("(?:%s)" % pattern[1:-1])
+        else:
+            expressions.append("(?:%s)" % fnmatch.translate(pattern))
+    return re.compile("|".join(expressions))
+
+
+def _select_metric(metric_filter, metric_name):
+    """
+    Returns True if a metric name is included, False if it is excluded and
+    None if no pattern matches. Exclusion wins over inclusion.
+    """
+    if metric_filter["exclude"] is not None and metric_filter["exclude"].match(metric_name):
+        return False
+    if metric_filter["include"] is not None and metric_filter["include"].match(metric_name):
         return True
-    if module_config["collect_mode"] == DETAILED_COLLECT_MODE:
-        return metric_name in metric_info.metric_detailed
-    return False
+    return None
+
+
+def _metric_spec(metric_name, module_config):
+    """
+    Returns the registry entry of a metric if it is collected in the current
+    CollectMode and metric filters, otherwise None.
+    """
+    spec = metric_info.registry.get(metric_name)
+    if spec is None:
+        return None
+    metric_filter = module_config["metric_filter"]
+    if metric_filter is not None:
+        try:
+            selected = metric_filter["selected"][metric_name]
+        except KeyError:
+            selected = metric_filter["selected"][metric_name] = _select_metric(metric_filter, metric_name)
+        if selected is False:
+            return None
+        if selected and not _under_pressure(module_config):
+            return spec
+    if spec.default:
+        return spec
+    if module_config["collect_mode"] == DETAILED_COLLECT_MODE and not _under_pressure(module_config):
+        return spec
+    return None
+
+
+def _under_pressure(module_config):
+    adaptive = module_config["adaptive"]
+    return adaptive is not None and adaptive["under_pressure"]
 
 
 def _process_metric(metric_name_pref, metric_name, value, dimensions, module_config):
     metric_name = metric_name_pref + "." + metric_name
-    if _is_metric_name_allowed(metric_name, module_config):
-        return Metric(metric_name, value, dimensions)
+    spec = _metric_spec(metric_name, module_config)
+    if spec is not None:
+        return Metric(metric_name, value, dimensions, spec.type)
     return None
 
 
@@ -250,9 +1297,11 @@ def _parse_metrics(obj_to_parse, dimensions, request_type, module_config):
             value = obj_to_parse["nodes"]
             metric_name_pref = "nodes"
             for node in value:
-                if "thisNode" in node and node["thisNode"] is True:
+                if module_config["collect_all_nodes"] or ("thisNode" in node and node["thisNode"] is True):
                     dimensions = dict(dimensions)
                     dimensions["node"] = node.get("hostname")
+                    if module_config["counter_rates"] is not None:
+                        _check_node_restart(module_config["counter_rates"], dimensions["node"], node.get("uptime"))
                     metrics.extend(_parse_with_prefix(metric_name_pref, node, dimensions, module_config))
     elif request_type == REQUEST_TYPE_BUCKET:
         if "quota" in obj_to_parse:
@@ -275,7 +1324,9 @@ def _parse_metrics(obj_to_parse, dimensions, request_type, module_config):
                     if metric:
                         metrics.append(metric)
 
-        if 'hot_keys' in obj_to_parse:
+        if 'hot_keys' in obj_to_parse and module_config["hot_keys"] is not None:
+            metrics.extend(_parse_hot_keys(obj_to_parse['hot_keys'], dimensions, module_config))
+        elif 'hot_keys' in obj_to_parse:
             hot_keys = obj_to_parse['hot_keys']
             key = 0
             metric_name_pref = 'bucket.hot_keys'
@@ -295,6 +1346,112 @@ def _parse_metrics(obj_to_parse, dimensions, request_type, module_config):
     return metrics
 
 
+def _parse_hot_keys(hot_keys, dimensions, module_config, now=None):
+    """
+    Returns the HotKeys busiest keys of a hot_keys list as bucket.hot_keys.ops
+    metrics with the document key in the key dimension.
+    """
+    spec = _metric_spec(HOT_KEY_METRIC, module_config)
+    if spec is None:
+        return []
+    if now is None:
+        now = time.time()
+    settings = module_config["hot_keys"]
+    entries = [
+        (entry.get("ops"), entry.get("name"))
+        for entry in hot_keys
+        if isinstance(entry, dict) and entry.get("name") is not None and isinstance(entry.get("ops"), numbers.Number)
+    ]
+    # The key follows the node and bucket in plugin_instance and gets the room
+    # the other dimensions leave, but at least that of its hash, so keys stay
+    # distinct when the dimensions after it are truncated
+    if module_config["dimension_transport"] == DIMENSION_TRANSPORT_META:
+        budget = float("inf")
+    else:
+        dimensions_length = len(",".join("%s=%s" % item for item in dimensions.items()))
+        budget = max(HOT_KEY_HASH_LENGTH, module_config["field_length"] - 2 - dimensions_length - len(",key="))
+    metrics = []
+    for ops, name in heapq.nlargest(settings["top"], entries, key=lambda entry: entry[0]):
+        key = _fit_hot_key(six.text_type(name), budget)
+        if _admit_hot_key(settings, (dimensions.get("node"), key), now, _series_interval(module_config)):
+            metrics.append(Metric(HOT_KEY_METRIC, ops, dict(dimensions, key=key), spec.type))
+    return metrics
+
+
+def _fit_hot_key(key, length):
+    """
+    Makes a document key safe to use as a dimension value and shortens it to
+    length characters by replacing its end with a hash of the whole key.
+    """
+    key = re.sub(r"[,=\[\]]", "_", key)
+    if len(key) <= length:
+        return key
+    digest = hashlib.md5(key.encode("utf-8")).hexdigest()[:HOT_KEY_HASH_LENGTH]
+    prefix = key[: max(0, length - HOT_KEY_HASH_LENGTH - 1)]
+    return prefix + "~" + digest if prefix else digest
+
+
+def _series_interval(module_config):
+    """
+    Returns the longest time between two values of a series of the Module:
+    the interval of its slowest metric group, stretched while cycles overrun
+    or the cluster is under pressure.
+    """
+    state = module_config["cycle_state"]
+    slowest = max(group["interval"] for group in module_config["group_schedule"].values())
+    return slowest * max(state["stretch"], state["pressure_stretch"])
+
+
+def _admit_hot_key(settings, series, now, interval):
+    """
+    Records a hot key series as seen and returns whether it may be sent. A
+    new series beyond MaxHotKeySeries replaces the least recently seen one,
+    unless that one was seen within the current interval.
+    """
+    with settings["lock"]:
+        known = settings["series"]
+        if series in known:
+            del known[series]
+        elif len(known) >= settings["max_series"]:
+            oldest, seen = next(iter(known.items()))
+            if now - seen < interval:
+                settings["dropped"] += 1
+                return False
+            del known[oldest]
+            settings["evicted"] += 1
+        known[series] = now
+    return True
+
+
+def _series_dimensions(dimensions, module_config):
+    """
+    Returns the plugin_instance and meta of a value with the given dimensions,
+    built once per dimension set. With DimensionTransport meta, dimensions are
+    carried untruncated in meta and plugin_instance only holds a hash of them
+    that keeps series apart in collectd.
+    """
+    cache = module_config["dimension_cache"]
+    key = frozenset(dimensions.items())
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    if len(cache) >= DIMENSION_CACHE_SIZE:
+        cache.clear()
+    if module_config["dimension_transport"] == DIMENSION_TRANSPORT_META:
+        meta = dict((name, six.text_type(value)) for name, value in dimensions.items() if value is not None)
+        pairs = ",".join("%s=%s" % item for item in sorted(meta.items()))
+        plugin_instance = hashlib.md5(pairs.encode("utf-8")).hexdigest()[:SERIES_ID_LENGTH]
+    else:
+        plugin_instance = _format_dimensions(dimensions, module_config["field_length"])
+        # With some versions of CollectD, a dummy metadata map must be added
+        # to each value for it to be correctly serialized to JSON by the
+        # write_http plugin. See
+        # https://github.com/collectd/collectd/issues/716
+        meta = {"0": True}
+    cached = cache[key] = (plugin_instance, meta)
+    return cached
+
+
 def _format_dimensions(dimensions, field_length=DEFAULT_FIELD_LENGTH):
     """
     Formats a dictionary of dimensions to a format that enables them to be
@@ -317,30 +1474,68 @@ def _format_dimensions(dimensions, field_length=DEFAULT_FIELD_LENGTH):
         dim_pairs.append("node=%s" % dimensions["node"])
     if "bucket" in dimensions:
         dim_pairs.append("bucket=%s" % dimensions["bucket"])
-    dim_pairs.extend("%s=%s" % (k, v) for k, v in dimensions.items() if k != "node" and k != "bucket")
+    # Hot keys are next, sized so the node, bucket and key always fit
+    if "key" in dimensions:
+        dim_pairs.append("key=%s" % dimensions["key"])
+    dim_pairs.extend("%s=%s" % (k, v) for k, v in dimensions.items() if k not in ("node", "bucket", "key"))
     dim_str = ",".join(dim_pairs)[:trunc_len]
     return "[%s]" % dim_str
 
 
-def _post_metrics(metrics, module_config):
+def _post_metrics(metrics, module_config, capped=True):
     """
-    Posts metrics to collectd.
+    Posts metrics to collectd, or adds them to the batch of the cycle with
+    OutputMode http.
     Args:
     :param metrics : Array of Metrics objects
+    :param capped : Whether new series count against MaxSeries
     """
+    suppression = module_config["suppression"]
+    series_registry = module_config["series_registry"] if capped else None
+    output = module_config["output"]
+    prometheus = module_config["prometheus"]
+    now = time.time()
+    series_interval = _series_interval(module_config)
     for metric in metrics:
+        plugin_instance, meta = _series_dimensions(metric.dimensions, module_config)
+        if series_registry is not None and not series_registry.admit(
+            metric.name, plugin_instance, now, series_interval
+        ):
+            continue
+        # Scrapes always see the latest value, even if it is not sent again
+        if prometheus is not None:
+            prometheus["samples"].append((metric.name, metric.type, metric.dimensions, metric.value))
+        if suppression is not None and _is_unchanged(suppression, (metric.name, plugin_instance), metric.value, now):
+            continue
+
+        # DERIVE and COUNTER data sources only take integers
+        value = metric.value if metric.type == DEFAULT_METRIC_TYPE else int(metric.value)
+        if output is not None:
+            output["batch"].append(
+                {
+                    "values": [value],
+                    "dstypes": [metric.type],
+                    "dsnames": ["value"],
+                    "time": now,
+                    "interval": float(module_config["read_interval"]),
+                    "host": output["host"],
+                    "plugin": PLUGIN_NAME,
+                    "plugin_instance": plugin_instance,
+                    "type": metric.type,
+                    "type_instance": metric.name,
+                    "meta": meta,
+                }
+            )
+            continue
+
         datapoint = collectd.Values()
-        datapoint.type = DEFAULT_METRIC_TYPE
+        datapoint.type = metric.type
         datapoint.type_instance = metric.name
         datapoint.plugin = PLUGIN_NAME
-        datapoint.plugin_instance = _format_dimensions(metric.dimensions, module_config["field_length"])
-        datapoint.values = (metric.value,)
+        datapoint.plugin_instance = plugin_instance
+        datapoint.values = (value,)
 
-        # With some versions of CollectD, a dummy metadata map must be added
-        # to each value for it to be correctly serialized to JSON by the
-        # write_http plugin. See
-        # https://github.com/collectd/collectd/issues/716
-        datapoint.meta = {"0": True}
+        datapoint.meta = meta
 
         pprint_dict = {
             "plugin": datapoint.plugin,
@@ -354,25 +1549,875 @@ def _post_metrics(metrics, module_config):
         datapoint.dispatch()
 
 
-def _first_in_sorted_nodes_list(base_url, opener, resp_obj=None):
-    if resp_obj is None:
-        api_url = "%s/%s" % (base_url, "pools/default")
-        collectd.debug("GET " + api_url)
-        resp_obj = _api_call(api_url, opener)
+def _build_output(ingest_url, user=None, password=None, timeout=DEFAULT_INGEST_TIMEOUT):
+    """
+    Returns the state of OutputMode http: the batch of the current cycle,
+    where and how to send it, and the counters posted as self-metrics.
+    """
+    parts = urllib.parse.urlsplit(ingest_url)
+    if parts.scheme not in ("http", "https") or not parts.netloc:
+        raise ValueError("Invalid IngestURL parameter: %s" % ingest_url)
+    headers = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+    if user is not None or password is not None:
+        credentials = ("%s:%s" % (user or "", password or "")).encode("utf-8")
+        headers["Authorization"] = "Basic " + base64.b64encode(credentials).decode("ascii")
+    return {
+        "endpoint": (parts.scheme, parts.netloc),
+        "path": urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, "")),
+        "headers": headers,
+        # collectd names hosts by their fully qualified name by default
+        "host": socket.getfqdn(),
+        "timeout": timeout,
+        "batch": [],
+        "spool": None,
+        "batches": 0,
+        "failures": 0,
+        "values": 0,
+    }
+
+
+def _flush_output(module_config):
+    """
+    Sends the values batched during a cycle to IngestURL as one gzipped
+    write_http JSON document. Returns False if the batch could not be sent,
+    in which case it is spooled if SpoolDirectory is set; after a successful
+    send, spooled batches are replayed.
+    """
+    output = module_config["output"]
+    batch, output["batch"] = output["batch"], []
+    if not batch:
+        return True
+    compressor = zlib.compressobj(INGEST_COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    body = compressor.compress(json.dumps(batch).encode("utf-8")) + compressor.flush()
+    timeout = output["timeout"]
+    spool = output["spool"]
+    if _post_batch(output, body, timeout):
+        output["batches"] += 1
+        output["values"] += len(batch)
+        if spool is not None:
+            output["batches"] += spool.replay(lambda spooled: _post_batch(output, spooled, timeout), time.time())
+        return True
+    output["failures"] += 1
+    if spool is not None:
+        spool.append(body, time.time())
+    return False
+
+
+def _post_batch(output, body, timeout):
+    """
+    POSTs a batch over a pooled keep-alive connection to the ingest endpoint.
+    A pooled connection may have been closed by the server in the meantime,
+    so a request failing on one is retried once on a new connection; a
+    request failing on a new connection is not.
+    """
+    error = None
+    for attempt in range(2):
+        connection, pooled = _ingest_connection(output["endpoint"], timeout, fresh=attempt > 0)
+        try:
+            connection.request("POST", output["path"], body, output["headers"])
+            response = connection.getresponse()
+            response.read()
+        except (http_client.HTTPException, socket.error) as e:
+            connection.close()
+            error = e
+            if not pooled:
+                break
+            continue
+        _release_ingest_connection(output["endpoint"], connection)
+        if 200 <= response.status < 300:
+            return True
+        collectd.error("Ingest endpoint %s://%s returned %s %s" % (
+            output["endpoint"][0], output["endpoint"][1], response.status, response.reason))
+        return False
+    collectd.error("Unable to send batch to %s://%s: %s" % (output["endpoint"][0], output["endpoint"][1], error))
+    return False
+
+
+def _ingest_connection(endpoint, timeout, fresh=False):
+    """
+    Returns an idle pooled connection to the ingest endpoint, or a new one,
+    and whether it was pooled.
+    """
+    with INGEST_CONNECTIONS_LOCK:
+        idle = INGEST_CONNECTIONS.setdefault(endpoint, [])
+        if idle and not fresh:
+            return idle.pop(), True
+    scheme, netloc = endpoint
+    if scheme == "https":
+        return http_client.HTTPSConnection(netloc, timeout=timeout), False
+    return http_client.HTTPConnection(netloc, timeout=timeout), False
+
+
+def _release_ingest_connection(endpoint, connection):
+    with INGEST_CONNECTIONS_LOCK:
+        INGEST_CONNECTIONS.setdefault(endpoint, []).append(connection)
+
+
+def _is_unchanged(suppression, series, value, now):
+    """
+    Returns True if the value of a series equals its last dispatched value
+    and may be suppressed. Every HeartbeatIntervals-th repeat is sent anyway
+    so downstream staleness detection keeps working. Series not seen for
+    more than HeartbeatIntervals cycles of the slowest group, e.g. of a
+    removed bucket or node, are evicted from the front.
+    """
+    tracked = suppression["series"]
+    while tracked:
+        oldest, (_, _, idle_after) = next(iter(tracked.items()))
+        if idle_after > now:
+            break
+        del tracked[oldest]
+        suppression["evicted"] += 1
+    last = tracked.pop(series, None)
+    idle_after = now + suppression["idle_after"]
+    if last is not None and last[0] == value and last[1] < suppression["heartbeat"] - 1:
+        tracked[series] = (value, last[1] + 1, idle_after)
+        suppression["suppressed"] += 1
+        return True
+    tracked[series] = (value, 0, idle_after)
+    return False
+
+
+def _derive_metrics(metrics, module_config):
+    """
+    Evaluates the formulas of metric_info.derived_metrics over the metrics of
+    one response, once per set of dimensions found in them, and returns the
+    results as new gauge metrics. Formulas whose inputs were not collected
+    are skipped.
+    """
+    previous_by_dimensions = module_config["derived"]["previous"]
+    groups = collections.OrderedDict()
+    for metric in metrics:
+        key = tuple(sorted(metric.dimensions.items()))
+        if key not in groups:
+            groups[key] = (metric.dimensions, {})
+        groups[key][1][metric.name] = metric.value
+
+    derived = []
+    for key, (dimensions, values) in groups.items():
+        previous = previous_by_dimensions.get(key, {})
+        for spec in metric_info.derived_metrics:
+            args = [values.get(name) for name in spec.inputs]
+            args.extend(previous.get(name) for name in spec.previous_inputs)
+            if None in args:
+                continue
+            value = spec.formula(*args)
+            if value is not None:
+                derived.append(Metric(spec.name, value, dimensions))
+        kept = dict(previous)
+        kept.update((name, values[name]) for name in metric_info.derived_previous_inputs if name in values)
+        if kept:
+            previous_by_dimensions[key] = kept
+    return derived
+
+
+def _convert_counters(metrics, module_config, now=None):
+    """
+    Replaces, or with CounterRates both complements, every derive or counter
+    metric by its per-second rate since the previous cycle, sent as a gauge
+    named after the counter with a ".rate" suffix. The first value of a
+    series and a value lower than the previous one, i.e. a counter reset,
+    only set the baseline; counter types may instead wrap around at 32 or 64
+    bits.
+    """
+    rates = module_config["counter_rates"]
+    if now is None:
+        now = time.time()
+    converted = []
+    for metric in metrics:
+        if metric.type == DEFAULT_METRIC_TYPE:
+            converted.append(metric)
+            continue
+        if rates["keep_raw"]:
+            converted.append(metric)
+
+        series = (metric.name, tuple(sorted(metric.dimensions.items())))
+        last = rates["series"].get(series)
+        rates["series"][series] = (metric.value, now)
+        if last is None or now <= last[1]:
+            continue
+        delta = metric.value - last[0]
+        if delta < 0:
+            delta = _counter_wrap(last[0], metric.value) if metric.type == metric_info.COUNTER else None
+            if delta is None:
+                _increment(module_config, rates, "resets")
+                continue
+        converted.append(Metric(metric.name + RATE_SUFFIX, delta / float(now - last[1]), metric.dimensions))
+    return converted
+
+
+def _counter_wrap(previous, value):
+    """
+    Returns the increase of a counter that wrapped around from previous to
+    value, or None if previous was not close enough to a wrap boundary for
+    the drop to be anything but a reset.
+    """
+    for width in COUNTER_WRAP_WIDTHS:
+        limit = 2 ** width
+        if previous < limit and previous >= limit * 3 // 4:
+            return limit - previous + value
+    return None
+
+
+def _check_node_restart(rates, node, uptime):
+    """
+    Drops the counter baselines of a node whose uptime went backwards, as its
+    counters restarted from zero and must not be compared with values from
+    before the restart.
+    """
+    try:
+        uptime = float(uptime)
+    except (TypeError, ValueError):
+        return
+    last = rates["uptimes"].get(node)
+    rates["uptimes"][node] = uptime
+    if last is None or uptime >= last:
+        return
+    collectd.info("Node %s restarted, resetting its counter rates" % node)
+    for series in list(rates["series"]):
+        if ("node", node) in series[1]:
+            del rates["series"][series]
+
+
+def _cluster_api_call(module_config, path):
+    """
+    Makes a REST call for a path that any node of the cluster can answer. The
+    seed node is always tried first, so collection returns to it as soon as
+    it recovers; if it fails, up to FailoverPeers known peers are tried in
+    order of their measured latency.
+    Returns:
+    tuple: The JSON response and the base URL of the node that answered, or
+    (None, None)
+    """
+    candidates = [module_config["base_url"]] + _failover_candidates(module_config["cluster"])
+    return _try_nodes(module_config, path, candidates)
+
+
+def _try_nodes(module_config, path, base_urls):
+    for base_url in base_urls:
+        resp_obj = _timed_api_call(module_config, base_url, path)
+        if resp_obj is not None:
+            if base_url != module_config["base_url"]:
+                _increment(module_config, module_config["cluster"], "failovers")
+                collectd.info(
+                    "Seed node %s unavailable, %s answered by %s" % (module_config["base_url"], path, base_url)
+                )
+            return resp_obj, base_url
+    return None, None
+
+
+def _timed_api_call(module_config, base_url, path, abandoned=None):
+    """
+    Makes a REST call and records its latency, unless the abandoned event of
+    a hedged call was set while it ran.
+    """
+    cluster = module_config["cluster"]
+    api_url = "%s/%s" % (base_url, path.lstrip("/"))
+    collectd.debug("GET " + api_url)
+    start = time.time()
+    resp_obj = _api_call(api_url, module_config["opener"], module_config["http_timeout"])
+    if abandoned is not None and abandoned.is_set():
+        return None
+    latency = None if resp_obj is None else time.time() - start
+    _record_latency(cluster, base_url, latency)
+    if latency is not None and base_url == module_config["base_url"]:
+        cluster["seed_latencies"].append(latency)
+    adaptive = module_config["adaptive"]
+    if latency is not None and adaptive is not None:
+        previous = adaptive["latency"]
+        adaptive["latency"] = latency if previous is None else previous + LATENCY_SMOOTHING * (latency - previous)
+    return resp_obj
+
+
+def _hedged_api_call(module_config, path):
+    """
+    Makes a REST call for a cluster-wide path whose response does not depend
+    on the node asked. With HedgeRequests enabled, if the seed node has not
+    answered after its HedgePercentile latency, the same request is sent to
+    the fastest healthy peer and the first successful response is used.
+    urllib cannot cancel a request in flight, so the slower request is
+    abandoned rather than cancelled: it keeps its connection and thread until
+    it completes or times out, and its response and latency are discarded. A
+    seed that lost is recorded with the time it was waited for instead.
+    Returns:
+    tuple: The JSON response and the base URL of the node that answered, or
+    (None, None)
+    """
+    hedge = module_config["hedge"]
+    cluster = module_config["cluster"]
+    if hedge is None:
+        return _cluster_api_call(module_config, path)
+    _increment(module_config, hedge, "eligible")
+    peers = [peer for peer in _failover_candidates(cluster) if cluster["latency"].get(peer) != float("inf")]
+    over_budget = hedge["hedged"] >= hedge["max_ratio"] * hedge["eligible"]
+    if not peers or over_budget or len(cluster["seed_latencies"]) < HEDGE_MIN_SAMPLES:
+        return _cluster_api_call(module_config, path)
+
+    results = queue.Queue()
+    abandoned = threading.Event()
+
+    def request(base_url):
+        resp_obj = None
+        try:
+            resp_obj = _timed_api_call(module_config, base_url, path, abandoned)
+        finally:
+            results.put((resp_obj, base_url))
+
+    def result(deadline):
+        try:
+            return results.get(timeout=max(0, deadline - time.time()))
+        except queue.Empty:
+            return None, None
+
+    tried = [module_config["base_url"]]
+    start = time.time()
+    _start_daemon_thread(request, module_config["base_url"])
+    try:
+        resp_obj, base_url = results.get(timeout=_percentile(cluster["seed_latencies"], hedge["percentile"]))
+    except queue.Empty:
+        _increment(module_config, hedge, "hedged")
+        tried.append(peers[0])
+        _start_daemon_thread(request, peers[0])
+        deadline = time.time() + HEDGE_WAIT_TIMEOUTS * module_config["http_timeout"]
+        resp_obj, base_url = result(deadline)
         if resp_obj is None:
-            collectd.error("Unable to get list of nodes in the cluster")
+            resp_obj, base_url = result(deadline)
+        abandoned.set()
+        if resp_obj is not None and base_url != module_config["base_url"]:
+            _increment(module_config, hedge, "wins")
+            cluster["seed_latencies"].append(time.time() - start)
+    if resp_obj is not None:
+        return resp_obj, base_url
+    # Neither answered, fail over to the remaining peers
+    return _try_nodes(module_config, path, [peer for peer in _failover_candidates(cluster) if peer not in tried])
+
+
+def _fetch_concurrently(module_config, paths):
+    """
+    Fetches several cluster-wide paths with up to MaxConcurrentRequests
+    worker threads.
+    Returns:
+    list: The JSON responses in the order of paths, None for failed calls
+    """
+    results = [None] * len(paths)
+    work = queue.Queue()
+    for item in enumerate(paths):
+        work.put(item)
+
+    def worker():
+        while True:
+            try:
+                index, path = work.get_nowait()
+            except queue.Empty:
+                return
+            results[index] = _hedged_api_call(module_config, path)[0]
+
+    workers = min(module_config["max_concurrent_requests"], len(paths))
+    for thread in [_start_daemon_thread(worker) for _ in range(workers)]:
+        thread.join()
+    return results
+
+
+def _increment(module_config, counters, key):
+    """
+    Increments a module counter that CollectAllNodes worker threads may
+    update concurrently.
+    """
+    with module_config["counter_lock"]:
+        counters[key] += 1
+
+
+def _start_daemon_thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _percentile(samples, percentile):
+    ordered = sorted(samples)
+    index = max(int(math.ceil(percentile / 100.0 * len(ordered))) - 1, 0)
+    return ordered[index]
+
+
+def _failover_candidates(cluster):
+    peers = sorted(cluster["peers"], key=lambda peer: cluster["latency"].get(peer, 0.0))
+    return peers[: cluster["max_peers"]]
+
+
+def _record_latency(cluster, base_url, latency):
+    """
+    Keeps a moving average of each node's response time. Failed calls make
+    the node the last failover choice until it answers again.
+    """
+    previous = cluster["latency"].get(base_url)
+    if latency is None:
+        cluster["latency"][base_url] = float("inf")
+    elif previous is None or previous == float("inf"):
+        cluster["latency"][base_url] = latency
+    else:
+        cluster["latency"][base_url] = previous + LATENCY_SMOOTHING * (latency - previous)
+
+
+def _update_membership(module_config, resp_obj, base_url):
+    """
+    Remembers the cluster nodes listed in a pools/default response as
+    failover peers. The seed's own hostname is only learned from responses of
+    the seed, where thisNode refers to it; responses of a peer get thisNode
+    relabeled so per-node metrics keep describing the seed.
+    Returns:
+    dict: The response as seen from the seed node
+    """
+    cluster = module_config["cluster"]
+    if base_url == module_config["base_url"]:
+        for node in resp_obj.get("nodes", []):
+            if node.get("thisNode") is True:
+                cluster["this_node"] = node.get("hostname")
+    else:
+        resp_obj = dict(resp_obj)
+        resp_obj["nodes"] = [
+            dict(node, thisNode=node.get("hostname") == cluster["this_node"]) for node in resp_obj.get("nodes", [])
+        ]
+
+    peers = []
+    for node in resp_obj.get("nodes", []):
+        hostname = node.get("hostname")
+        if not hostname or hostname == cluster["this_node"]:
+            continue
+        peer_url = "http://%s" % hostname
+        if peer_url not in cluster["peers"]:
+            module_config["auth"].add_password(
+                None, user=module_config["username"], passwd=module_config["password"], uri=peer_url
+            )
+            _get_breaker(peer_url, *module_config["breaker_settings"])
+        peers.append(peer_url)
+    cluster["peers"] = peers
+    return resp_obj
+
+
+def _get_cluster_nodes(module_config):
+    """
+    Fetches pools/default from the seed node or a failover peer and updates
+    the known cluster membership.
+    """
+    resp_obj, base_url = _cluster_api_call(module_config, "pools/default")
+    if resp_obj is None:
+        collectd.error("Unable to get list of nodes in the cluster")
+        return None
+    module_config["cluster"]["refreshed"] = time.time()
+    if module_config["adaptive"] is not None:
+        module_config["adaptive"]["rebalancing"] = resp_obj.get("rebalanceStatus", "none") != "none"
+    return _update_membership(module_config, resp_obj, base_url)
+
+
+def _get_this_node(module_config):
+    """
+    Fetches the much smaller nodes/self document of the seed node, shaped
+    like a pools/default response listing only this node. Falls back to
+    pools/default, which failover peers can answer, if the seed fails.
+    """
+    cluster = module_config["cluster"]
+    if cluster["max_peers"] > 0 and time.time() - cluster["refreshed"] >= MEMBERSHIP_REFRESH_INTERVAL:
+        # Keep the failover peers known even though pools/default is not
+        # needed for metrics
+        return _get_cluster_nodes(module_config)
+    node = _timed_api_call(module_config, module_config["base_url"], "nodes/self")
+    if node is None:
+        return _get_cluster_nodes(module_config)
+    cluster["this_node"] = node.get("hostname", cluster["this_node"])
+    if module_config["adaptive"] is not None:
+        _update_rebalance_status(module_config)
+    node = dict(node)
+    node["thisNode"] = True
+    return {"nodes": [node]}
+
+
+def _refresh_cluster_state(module_config, now):
+    """
+    Keeps the failover peers and the rebalance state of a Module current when
+    its reads do not fetch pools/default, by fetching it every
+    MEMBERSHIP_REFRESH_INTERVAL and the rebalance state in between.
+    """
+    cluster = module_config["cluster"]
+    if cluster["max_peers"] > 0 and now - cluster["refreshed"] >= MEMBERSHIP_REFRESH_INTERVAL:
+        if _get_cluster_nodes(module_config) is not None:
+            return
+    if module_config["adaptive"] is not None:
+        _update_rebalance_status(module_config)
+
+
+def _update_rebalance_status(module_config):
+    """
+    Reads the rebalance state for AdaptivePolling from the small
+    rebalanceProgress document when pools/default, which also carries it,
+    is not fetched in this cycle.
+    """
+    resp_obj, _ = _cluster_api_call(module_config, "pools/default/rebalanceProgress")
+    if resp_obj is not None:
+        module_config["adaptive"]["rebalancing"] = resp_obj.get("status", "none") != "none"
+
 
-    nodes = resp_obj["nodes"]
+def _sorted_nodes_list(resp_obj):
+    """
+    Returns the hostname of the node that answered a pools/default request
+    and the sorted hostnames of all nodes of the cluster.
+    """
     current_node = None
     nodes_list = []
-    for node in nodes:
+    for node in resp_obj["nodes"]:
         if "thisNode" in node and node["thisNode"] is True:
             current_node = node["hostname"]
         nodes_list.append(node["hostname"])
     nodes_list.sort()
-    if current_node == nodes_list[0]:
-        return current_node, True
-    return current_node, False
+    return current_node, nodes_list
+
+
+def _rendezvous_owner(key, nodes_list):
+    """
+    Returns the node responsible for a unit of cluster-wide work using
+    rendezvous (highest random weight) hashing: every node scores the key and
+    the highest score wins. When a node joins or leaves, only the work it
+    wins or owned moves.
+    Args:
+    key (tuple): Identifies the work, e.g. (bucket, endpoint)
+    nodes_list (list): Hostnames of the cluster nodes
+    """
+    work = "|".join(key)
+    return max(
+        nodes_list, key=lambda node: hashlib.md5(("%s|%s" % (work, node)).encode("utf-8")).hexdigest()
+    )
+
+
+def _elect_leader(module_config, nodes_obj):
+    """
+    Updates the module's leader election from a pools/default response. If
+    the response has no thisNode entry, the node is identified by the
+    hostname learned earlier from the seed or by the configured Host:Port.
+    Returns:
+    LeaderElection: The module's election
+    """
+    plugin_config = module_config["plugin_config"]
+    fallback_nodes = (
+        module_config["cluster"]["this_node"],
+        "%s:%s" % (plugin_config["Host"], plugin_config["Port"]),
+    )
+    election = module_config["leader"]
+    election.update(nodes_obj, fallback_nodes)
+    return election
+
+
+def _emits_cluster_metrics(module_config):
+    """
+    Returns whether this collector emits the cluster-wide metrics of the
+    Module: always with CollectAllNodes, if it owns their unit of work with
+    ShardClusterWork, and if it is the leader otherwise.
+    """
+    if module_config["collect_all_nodes"]:
+        return True
+    election = module_config["leader"]
+    if module_config["shard_cluster_work"]:
+        return election.owns(module_config["cluster_work"])
+    return election.is_leader
+
+
+def read_callback(module_config):
+    """
+    Read callback registered with collectd for every Module. Skips the cycle
+    while the previous one of the same module is still running or while the
+    effective interval is stretched after repeated overruns, then runs the
+    module's read function, posts the scheduling self-metrics and, with
+    OutputMode http, sends the batch of the cycle.
+    :param module_config: Configuration from the plugin file
+    :return: None
+    """
+    state = module_config["cycle_state"]
+    start = time.time()
+    if start < state["next_due"]:
+        state["skipped"] += 1
+        return
+    if not state["lock"].acquire(False):
+        state["skipped"] += 1
+        collectd.warning("Skipping cycle of %s, the previous one is still running" % module_config["read_name"])
+        return
+    try:
+        try:
+            if module_config["profile"] is not None:
+                read_with_profiling(module_config)
+            else:
+                module_config["read_func"](module_config)
+        finally:
+            _post_cycle_metrics(module_config, time.time() - start)
+            # Sending the batch counts towards the cycle, so a slow ingest
+            # endpoint stretches the interval like a slow Couchbase does
+            if module_config["output"] is not None:
+                _flush_output(module_config)
+    finally:
+        duration = time.time() - start
+        if module_config["adaptive"] is not None:
+            _update_pressure(module_config["adaptive"], state)
+        _update_cycle_schedule(state, start, duration, module_config["read_interval"])
+        state["lock"].release()
+
+    prometheus = module_config["prometheus"]
+    if prometheus is not None:
+        samples, prometheus["samples"] = prometheus["samples"], []
+        prometheus["exporter"].publish(module_config["read_name"], samples, prometheus["stale_after"])
+
+
+def _post_cycle_metrics(module_config, duration):
+    """
+    Posts the self-metrics of a cycle that has taken duration seconds so far.
+    """
+    state = module_config["cycle_state"]
+    breaker = module_config["breaker"]
+    _post_self_metrics(
+        {
+            "cycle_duration": duration,
+            "cycles_skipped": state["skipped"],
+            "effective_interval": module_config["read_interval"] * max(state["stretch"], state["pressure_stretch"]),
+            "circuit_breaker.state": breaker.state,
+            "circuit_breaker.failures": breaker.failures,
+            "failover_calls": module_config["cluster"]["failovers"],
+            "leader": int(_emits_cluster_metrics(module_config)),
+        },
+        module_config,
+    )
+    suppression = module_config["suppression"]
+    if suppression is not None:
+        _post_self_metrics(
+            {
+                "suppressed_datapoints": suppression["suppressed"],
+                "suppression_series": len(suppression["series"]),
+                "suppression_evicted": suppression["evicted"],
+            },
+            module_config,
+        )
+    series_registry = module_config["series_registry"]
+    if series_registry is not None:
+        _post_self_metrics(
+            {
+                "series_tracked": len(series_registry.series),
+                "series_dropped": series_registry.dropped,
+                "series_evicted": series_registry.evicted,
+            },
+            module_config,
+        )
+    hot_keys = module_config["hot_keys"]
+    if hot_keys is not None:
+        _post_self_metrics(
+            {
+                "hot_key_series": len(hot_keys["series"]),
+                "hot_key_evictions": hot_keys["evicted"],
+                "hot_keys_dropped": hot_keys["dropped"],
+            },
+            module_config,
+        )
+    rates = module_config["counter_rates"]
+    if rates is not None:
+        _post_self_metrics({"counter_resets": rates["resets"], "counter_series": len(rates["series"])}, module_config)
+    adaptive = module_config["adaptive"]
+    if adaptive is not None:
+        _post_self_metrics(
+            {"api_latency": adaptive["latency"] or 0.0, "under_pressure": int(adaptive["under_pressure"])},
+            module_config,
+        )
+    if module_config["hedge"] is not None:
+        _post_self_metrics(
+            {"hedged_calls": module_config["hedge"]["hedged"], "hedge_wins": module_config["hedge"]["wins"]},
+            module_config,
+        )
+    output = module_config["output"]
+    if output is not None:
+        _post_self_metrics(
+            {
+                "output_batches": output["batches"],
+                "output_failures": output["failures"],
+                "output_values": output["values"],
+            },
+            module_config,
+        )
+        spool = output["spool"]
+        if spool is not None:
+            _post_self_metrics(
+                {
+                    "spool_bytes": spool.size,
+                    "spool_batches": spool.pending,
+                    "spool_dropped": spool.dropped,
+                    "spool_expired": spool.expired,
+                    "spool_replayed": spool.replayed,
+                },
+                module_config,
+            )
+
+
+def _due_groups(module_config, now=None):
+    """
+    Returns the metric groups due in this cycle. Half a read interval of
+    slack keeps a slower group from slipping a whole cycle because of
+    scheduling jitter.
+    """
+    now = now or time.time()
+    read_interval = module_config["read_interval"]
+    due = set()
+    for group, schedule in module_config["group_schedule"].items():
+        # Groups at the read interval are due whenever collectd calls
+        if schedule["interval"] <= read_interval or now + read_interval / 2.0 >= schedule["next_due"]:
+            due.add(group)
+    return due
+
+
+def _schedule_group(module_config, group, now):
+    """
+    Schedules the next fetch of a group once it was collected, so a failed
+    fetch is retried in the next cycle instead of after the group interval.
+    """
+    schedule = module_config["group_schedule"][group]
+    schedule["next_due"] = now + schedule["interval"]
+
+
+def _update_pressure(adaptive, state):
+    """
+    Doubles the interval stretch caused by cluster pressure, up to
+    MaxIntervalStretch, while the average API latency is above
+    AdaptiveLatencyThreshold or a rebalance is running, and halves it again
+    per cycle once the pressure is gone. Detailed-only metrics and endpoints
+    are dropped while the stretch lasts.
+    """
+    latency = adaptive["latency"]
+    pressure = adaptive["rebalancing"] or (latency is not None and latency > adaptive["latency_threshold"])
+    if pressure:
+        state["pressure_stretch"] = min(state["pressure_stretch"] * 2, state["max_stretch"])
+    else:
+        state["pressure_stretch"] = max(state["pressure_stretch"] // 2, 1)
+    under_pressure = pressure or state["pressure_stretch"] > 1
+    if under_pressure != adaptive["under_pressure"]:
+        if under_pressure:
+            collectd.warning(
+                "Couchbase under pressure (latency %.3fs, rebalancing %s), backing off"
+                % (latency or 0.0, adaptive["rebalancing"])
+            )
+        else:
+            collectd.info("Couchbase pressure gone, back to normal polling")
+    adaptive["under_pressure"] = under_pressure
+
+
+def _update_cycle_schedule(state, start, duration, interval):
+    """
+    Stretches the effective interval after overrun_threshold consecutive
+    cycles took longer than the interval, and shrinks it back again after as
+    many cycles finished in time.
+    """
+    if duration > interval:
+        state["overruns"] += 1
+        state["recoveries"] = 0
+        if state["overruns"] >= state["overrun_threshold"] and state["stretch"] < state["max_stretch"]:
+            state["stretch"] = min(state["stretch"] * 2, state["max_stretch"])
+            state["overruns"] = 0
+            collectd.warning("Cycles overrun the interval, stretching it to %ss" % (interval * state["stretch"]))
+    else:
+        state["overruns"] = 0
+        if state["stretch"] > 1:
+            state["recoveries"] += 1
+            if state["recoveries"] >= state["overrun_threshold"]:
+                state["stretch"] //= 2
+                state["recoveries"] = 0
+                collectd.info("Cycles recovered, shrinking the interval to %ss" % (interval * state["stretch"]))
+    # collectd keeps calling at the configured interval; calls arriving before
+    # the stretched interval has elapsed are skipped. Half an interval of
+    # slack absorbs scheduling jitter.
+    stretch = max(state["stretch"], state["pressure_stretch"])
+    if stretch > 1:
+        state["next_due"] = start + interval * (stretch - 0.5)
+    else:
+        state["next_due"] = 0.0
+
+
+def _post_self_metrics(values, module_config):
+    """
+    Posts metrics about the plugin itself under the "plugin." prefix. They
+    bypass the CollectMode filter and MaxSeries.
+    """
+    dimensions = module_config["dimensions"]
+    metrics = [Metric("%s.%s" % (SELF_METRIC_PREFIX, name), value, dimensions) for name, value in values.items()]
+    _post_metrics(metrics, module_config, capped=False)
+
+
+def _check_profile_trigger(profile):
+    """
+    Arms profiling for more cycles if the trigger file exists. The file may
+    contain the number of cycles to profile; it is removed once consumed so
+    profiling can be re-armed on a running collectd by touching it again.
+    """
+    trigger_file = profile["trigger_file"]
+    if not trigger_file or not os.path.exists(trigger_file):
+        return
+    cycles = profile["default_cycles"]
+    try:
+        with open(trigger_file) as f:
+            content = f.read().strip()
+        if content:
+            cycles = int(content)
+    except (IOError, OSError, ValueError) as e:
+        collectd.warning("Unable to read profile trigger file %s (%s)" % (trigger_file, e))
+    try:
+        os.remove(trigger_file)
+    except OSError as e:
+        collectd.warning("Unable to remove profile trigger file %s (%s)" % (trigger_file, e))
+    profile["cycles_left"] += cycles
+    collectd.info("Profiling the next %d cycles, triggered by %s" % (cycles, trigger_file))
+
+
+def read_with_profiling(module_config):
+    """
+    Read callback used when profiling is configured. Runs the module's read
+    function under cProfile while profiled cycles remain and writes one
+    .pstats file per cycle, plus the top tracemalloc allocations if enabled.
+    :param module_config: Configuration from the plugin file
+    :return: None
+    """
+    profile = module_config["profile"]
+    read_func = module_config["read_func"]
+    _check_profile_trigger(profile)
+    if profile["cycles_left"] <= 0:
+        read_func(module_config)
+        return
+
+    profile["cycles_left"] -= 1
+    profile["cycle"] += 1
+    file_prefix = os.path.join(
+        profile["output"],
+        "couchbase-%s-%d-%d" % (re.sub(r"[^\w.-]", "_", module_config["read_name"]), os.getpid(), profile["cycle"]),
+    )
+
+    started_tracemalloc = False
+    if profile["tracemalloc"] and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        started_tracemalloc = True
+
+    profiler = cProfile.Profile()
+    start = time.time()
+    profiler.enable()
+    try:
+        read_func(module_config)
+    finally:
+        profiler.disable()
+        elapsed = time.time() - start
+        try:
+            profiler.dump_stats(file_prefix + ".pstats")
+            if profile["tracemalloc"]:
+                _dump_top_allocations(file_prefix + ".tracemalloc.txt")
+        except (IOError, OSError) as e:
+            collectd.error("Unable to write profile output %s (%s)" % (file_prefix, e))
+        if started_tracemalloc:
+            tracemalloc.stop()
+        collectd.info("Profiled cycle %d in %.3fs, written to %s.*" % (profile["cycle"], elapsed, file_prefix))
+
+
+def _dump_top_allocations(path, limit=DEFAULT_PROFILE_TOP_ALLOCATIONS):
+    snapshot = tracemalloc.take_snapshot()
+    with open(path, "w") as f:
+        for stat in snapshot.statistics("lineno")[:limit]:
+            f.write("%s\n" % stat)
 
 
 def read_node_stats(module_config):
@@ -383,20 +2428,36 @@ def read_node_stats(module_config):
     """
     collectd.debug("Executing read_node_stats callback")
 
-    api_url = "%s/%s" % (module_config["base_url"], "pools/default")
-    collectd.debug("GET " + api_url)
-    resp_obj = _api_call(api_url, module_config["opener"])
+    now = time.time()
+    due = _due_groups(module_config, now)
+    storage_due = module_config["cluster_stats_wanted"] and GROUP_STORAGE in due and not _under_pressure(module_config)
+    if not storage_due and GROUP_NODE_STATS not in due:
+        return
+
+    if storage_due or module_config["collect_all_nodes"]:
+        resp_obj = _get_cluster_nodes(module_config)
+    else:
+        resp_obj = _get_this_node(module_config)
     if resp_obj is None:
-        collectd.error("Unable to get list of nodes in the cluster")
+        return
 
     # Send cluster-wide node statistics only from one node
-    if _first_in_sorted_nodes_list(
-        base_url=module_config["base_url"], opener=module_config["opener"], resp_obj=resp_obj
-    ):
+    if not storage_due:
+        send_cluster_stats = False
+    elif module_config["collect_all_nodes"]:
+        send_cluster_stats = True
+    else:
+        _elect_leader(module_config, resp_obj)
+        send_cluster_stats = _emits_cluster_metrics(module_config)
+    if send_cluster_stats:
         _parse_and_post_metrics(resp_obj, REQUEST_TYPE_NODE, module_config)
+    if storage_due:
+        _schedule_group(module_config, GROUP_STORAGE, now)
 
-    # Send per-node metrics for all other nodes
-    _parse_and_post_metrics(resp_obj, REQUEST_TYPE_NODE_STAT, module_config)
+    # Send per-node metrics, for this node or with CollectAllNodes for all nodes
+    if GROUP_NODE_STATS in due:
+        _parse_and_post_metrics(resp_obj, REQUEST_TYPE_NODE_STAT, module_config)
+        _schedule_group(module_config, GROUP_NODE_STATS, now)
 
 
 def read_bucket_stats(module_config):
@@ -408,61 +2469,123 @@ def read_bucket_stats(module_config):
     collectd.debug("Executing read_bucket_stats callback")
 
     bucket_name = module_config["collect_bucket"]
+    collect_all_nodes = module_config["collect_all_nodes"]
+    now = time.time()
+    due = _due_groups(module_config, now)
+    if not due:
+        return
+
+    if collect_all_nodes:
+        # A single collector covers every node, so the node it talks to is
+        # irrelevant and the topology is only fetched to learn failover peers
+        # and the rebalance state
+        current_node, is_first_node = None, True
+        _refresh_cluster_state(module_config, now)
+    else:
+        nodes_obj = _get_cluster_nodes(module_config)
+        if nodes_obj is None:
+            return
+        election = _elect_leader(module_config, nodes_obj)
+        current_node = election.this_node
+        if current_node is None:
+            return
+        is_first_node = _emits_cluster_metrics(module_config)
 
     # Send cluster-wide bucket statistics only from one node
-    current_node, is_first_node = _first_in_sorted_nodes_list(
-        base_url=module_config["base_url"], opener=module_config["opener"]
-    )
-    if is_first_node:
-        api_url = "%s/%s/%s" % (module_config["base_url"], "pools/default/buckets", bucket_name)
-        collectd.debug("GET " + api_url)
-        resp_obj = _api_call(api_url, module_config["opener"])
+    if is_first_node and GROUP_BUCKET_BASIC in due:
+        resp_obj, _ = _hedged_api_call(module_config, "%s/%s" % ("pools/default/buckets", bucket_name))
         if resp_obj is None:
             collectd.error("Unable to get bucket statistics")
-        _parse_and_post_metrics(resp_obj, REQUEST_TYPE_BUCKET, module_config)
+        else:
+            _parse_and_post_metrics(resp_obj, REQUEST_TYPE_BUCKET, module_config)
+            _schedule_group(module_config, GROUP_BUCKET_BASIC, now)
+    elif GROUP_BUCKET_BASIC in due:
+        _schedule_group(module_config, GROUP_BUCKET_BASIC, now)
+
+    if GROUP_BUCKET_OPS not in due:
+        return
 
     # Collect per-node bucket stats
     # Get list of nodes containing the bucket
-    api_url = "%s/%s/%s/%s" % (module_config["base_url"], "pools/default/buckets", bucket_name, "nodes")
-    collectd.debug("GET " + api_url)
-    resp_obj = _api_call(api_url, module_config["opener"])
+    resp_obj, _ = _hedged_api_call(module_config, "%s/%s/%s" % ("pools/default/buckets", bucket_name, "nodes"))
     if resp_obj is None:
         collectd.error("Unable to get nodes containing the bucket " + bucket_name)
+        return
 
-    # Send per-node bucket stats
-    for server in resp_obj["servers"]:
-        if server["hostname"] == current_node:
-            api_url = "%s/%s" % (module_config["base_url"], server["stats"]["uri"])
-            resp_obj = _api_call(api_url, module_config["opener"])
-            if resp_obj is None:
-                collectd.error("Unable to get per-node bucket stats from " + api_url)
-            module_config["dimensions"]["node"] = server["hostname"]
-            _parse_and_post_metrics(resp_obj, REQUEST_TYPE_BUCKET_STAT, module_config)
-
-
-def _parse_and_post_metrics(resp_obj, request_type, module_config):
-    dimensions = module_config["dimensions"]
+    # Send per-node bucket stats, for this node or with CollectAllNodes for
+    # all nodes, fetched concurrently
+    servers = [server for server in resp_obj["servers"] if collect_all_nodes or server["hostname"] == current_node]
+    if collect_all_nodes:
+        stats = _fetch_concurrently(module_config, [server["stats"]["uri"] for server in servers])
+    else:
+        stats = [_hedged_api_call(module_config, server["stats"]["uri"])[0] for server in servers]
+    for server, stats_obj in zip(servers, stats):
+        if stats_obj is None:
+            collectd.error("Unable to get per-node bucket stats from " + server["stats"]["uri"])
+            continue
+        dimensions = dict(module_config["dimensions"])
+        dimensions["node"] = server["hostname"]
+        _parse_and_post_metrics(stats_obj, REQUEST_TYPE_BUCKET_STAT, module_config, dimensions)
+    if None not in stats:
+        _schedule_group(module_config, GROUP_BUCKET_OPS, now)
+
+
+def _parse_and_post_metrics(resp_obj, request_type, module_config, dimensions=None):
+    if dimensions is None:
+        dimensions = module_config["dimensions"]
 
     # 1. Parse metrics
     metrics = _parse_metrics(resp_obj, dimensions, request_type, module_config)
 
+    # 2. Compute derived metrics from the raw values
+    if module_config["derived"] is not None:
+        metrics.extend(_derive_metrics(metrics, module_config))
+
+    # 3. Convert counters to rates
+    if module_config["counter_rates"] is not None:
+        metrics = _convert_counters(metrics, module_config)
+
     collectd.debug("Interval: " + str(module_config["interval"]))
-    # 2. Post metrics
+    # 4. Post metrics
     _post_metrics(metrics, module_config)
 
 
 def init():
     """
-    The initialization callback is essentially a no-op for this plugin.
+    The initialization callback registers the read callbacks of staggered
+    modules once their start offset has elapsed, and starts the Prometheus
+    endpoints.
     """
     collectd.info("Initializing Couchbase plugin")
+    while DEFERRED_READS:
+        module_config = DEFERRED_READS.pop(0)
+        timer = threading.Timer(module_config["start_offset"], _register_read, args=(module_config,))
+        timer.daemon = True
+        timer.start()
+        STAGGER_TIMERS.append(timer)
+    # An endpoint that cannot be served must not stop the collection
+    with PROMETHEUS_EXPORTERS_LOCK:
+        for exporter in PROMETHEUS_EXPORTERS.values():
+            if exporter.server is None:
+                try:
+                    exporter.start()
+                except socket.error as e:
+                    collectd.error(
+                        "Unable to serve Prometheus metrics on %s:%d: %s" % (exporter.address, exporter.port, e)
+                    )
 
 
 def shutdown():
     """
-    The shutdown callback is essentially a no-op for this plugin.
+    The shutdown callback cancels staggered registrations still pending and
+    stops the Prometheus endpoints.
     """
     collectd.info("Stopping Couchbase plugin")
+    while STAGGER_TIMERS:
+        STAGGER_TIMERS.pop().cancel()
+    with PROMETHEUS_EXPORTERS_LOCK:
+        for exporter in PROMETHEUS_EXPORTERS.values():
+            exporter.stop()
 
 
 def setup_collectd():
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 SignalFx, Inc.
+"""
+Standalone runner for the Couchbase collectd plugin. It loads couchbase.py
+with a built-in shim in place of the collectd module, so collection can be
+run, timed and debugged without a collectd process. Emitted values are
+printed to stdout as JSON lines and per-phase timings to stderr.
+
+Usage:
+    python -m couchbase_collect CollectTarget=NODE Host=localhost Port=8091
+    python -m couchbase_collect --config module.conf --cycles 5 --no-wait
+
+The config file holds the same "Key Value" lines as a <Module couchbase>
+block of the collectd config.
+"""
+
+import argparse
+import collections
+import json
+import shlex
+import sys
+import time
+import types
+
+ConfigOption = collections.namedtuple("ConfigOption", ["key", "values"])
+ConfigBlock = collections.namedtuple("ConfigBlock", ["key", "values", "children"])
+ReadCallback = collections.namedtuple("ReadCallback", ["callback", "interval", "data", "name"])
+
+# Functions of couchbase.py timed as collection phases
+TIMED_PHASES = (("fetch", "_api_call"), ("parse", "_parse_metrics"), ("dispatch", "_post_metrics"))
+
+
+class CollectdShim(types.ModuleType):
+    """
+    Minimal stand-in for the module collectd exposes to Python plugins.
+    Registered callbacks are recorded and dispatched values are written to
+    the output stream as JSON lines.
+    """
+
+    def __init__(self, out=sys.stdout, log=sys.stderr, verbose=False):
+        super(CollectdShim, self).__init__("collectd")
+        self.out = out
+        self.log = log
+        self.verbose = verbose
+        self.config_callbacks = []
+        self.init_callbacks = []
+        self.read_callbacks = []
+        self.shutdown_callbacks = []
+        self.dispatched = 0
+        self.Values = self._values_class()
+
+    def _log(self, level, msg):
+        if self.verbose or level in ("warning", "error"):
+            self.log.write("[%s] %s\n" % (level, msg))
+
+    def debug(self, msg):
+        self._log("debug", msg)
+
+    def info(self, msg):
+        self._log("info", msg)
+
+    def warning(self, msg):
+        self._log("warning", msg)
+
+    def error(self, msg):
+        self._log("error", msg)
+
+    def register_config(self, callback, *args, **kwargs):
+        self.config_callbacks.append(callback)
+
+    def register_init(self, callback, *args, **kwargs):
+        self.init_callbacks.append(callback)
+
+    def register_shutdown(self, callback, *args, **kwargs):
+        self.shutdown_callbacks.append(callback)
+
+    def register_read(self, callback, interval=None, data=None, name=None):
+        self.read_callbacks.append(ReadCallback(callback, interval, data, name))
+
+    def _values_class(self):
+        shim = self
+
+        class Values(object):
+            def __init__(self, **kwargs):
+                self.host = ""
+                self.plugin = ""
+                self.plugin_instance = ""
+                self.type = ""
+                self.type_instance = ""
+                self.values = ()
+                self.time = 0
+                self.interval = 0
+                self.meta = {}
+                for key, value in kwargs.items():
+                    setattr(self, key, value)
+
+            def dispatch(self, **kwargs):
+                for key, value in kwargs.items():
+                    setattr(self, key, value)
+                shim.dispatched += 1
+                record = {
+                    "plugin": self.plugin,
+                    "plugin_instance": self.plugin_instance,
+                    "type": self.type,
+                    "type_instance": self.type_instance,
+                    "values": list(self.values),
+                    "time": self.time or time.time(),
+                    "meta": self.meta,
+                }
+                shim.out.write(json.dumps(record, sort_keys=True, default=str) + "\n")
+
+        return Values
+
+
+class PhaseTimer(object):
+    """
+    Wraps module functions so the time spent in each of them is accumulated
+    per phase.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+
+    def wrap(self, phase, func):
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.seconds[phase] += time.time() - start
+                self.calls[phase] += 1
+
+        return timed
+
+    def instrument(self, module, phases=TIMED_PHASES):
+        for phase, attr in phases:
+            setattr(module, attr, self.wrap(phase, getattr(module, attr)))
+
+
+def _convert_value(token, quoted):
+    """
+    Converts a config token the way collectd does: quoted tokens stay
+    strings, bare numbers become floats and bare true/false booleans.
+    """
+    if quoted:
+        return token
+    if token.lower() in ("true", "false"):
+        return token.lower() == "true"
+    try:
+        return float(token)
+    except ValueError:
+        return token
+
+
+def parse_config_line(line):
+    """
+    Parses one 'Key "value" ...' config line into a ConfigOption, or returns
+    None for blank lines, comments and block delimiters.
+    """
+    line = line.strip()
+    if not line or line.startswith("#") or line.startswith("<"):
+        return None
+    lexer = shlex.shlex(line, posix=False)
+    lexer.whitespace_split = True
+    lexer.commenters = "#"
+    tokens = list(lexer)
+    values = []
+    for token in tokens[1:]:
+        quoted = len(token) >= 2 and token[0] == token[-1] == '"'
+        values.append(_convert_value(token[1:-1] if quoted else token, quoted))
+    return ConfigOption(tokens[0], tuple(values))
+
+
+def build_config(options=(), config_file=None):
+    """
+    Builds a collectd-like config block from a config file and Key=Value
+    command line options. Command line values are kept as strings, like
+    quoted values in the collectd config.
+    """
+    children = []
+    if config_file:
+        with open(config_file) as f:
+            for line in f:
+                option = parse_config_line(line)
+                if option is not None:
+                    children.append(option)
+    for option in options:
+        key, sep, value = option.partition("=")
+        if not sep:
+            raise ValueError("Expected Key=Value, got %s" % option)
+        children.append(ConfigOption(key, (value,)))
+    return ConfigBlock("Module", ("couchbase",), children)
+
+
+def run_cycles(shim, timer, cycles, wait=True, report=sys.stderr):
+    """
+    Runs the registered read callbacks for the given number of cycles and
+    writes one JSON timing record per callback and cycle to report.
+    """
+    for cycle in range(cycles):
+        cycle_start = time.time()
+        for read in shim.read_callbacks:
+            timer.reset()
+            dispatched = shim.dispatched
+            start = time.time()
+            read.callback(read.data)
+            record = {
+                "cycle": cycle + 1,
+                "name": read.name,
+                "total": time.time() - start,
+                "values": shim.dispatched - dispatched,
+            }
+            for phase, _ in TIMED_PHASES:
+                record[phase] = timer.seconds[phase]
+                record[phase + "_calls"] = timer.calls[phase]
+            report.write(json.dumps(record, sort_keys=True) + "\n")
+        if wait and cycle + 1 < cycles and shim.read_callbacks:
+            interval = min(float(read.interval) for read in shim.read_callbacks)
+            time.sleep(max(0.0, interval - (time.time() - cycle_start)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the Couchbase collectd plugin outside of collectd")
+    parser.add_argument("options", nargs="*", metavar="Key=Value", help="Module config options")
+    parser.add_argument("-c", "--config", help="File with the Key Value lines of a <Module couchbase> block")
+    parser.add_argument("-n", "--cycles", type=int, default=1, help="Number of read cycles to run")
+    parser.add_argument("--no-wait", action="store_true", help="Do not wait for the interval between cycles")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Print plugin debug and info logs")
+    args = parser.parse_args(argv)
+
+    shim = CollectdShim(verbose=args.verbose)
+    sys.modules["collectd"] = shim
+    import couchbase
+
+    timer = PhaseTimer()
+    timer.instrument(couchbase)
+
+    config = build_config(args.options, args.config)
+    for callback in shim.config_callbacks:
+        callback(config)
+    for callback in shim.init_callbacks:
+        callback()
+    # Staggered modules register their read callback after their start offset
+    for stagger_timer in list(couchbase.STAGGER_TIMERS):
+        stagger_timer.join()
+    try:
+        run_cycles(shim, timer, args.cycles, wait=not args.no_wait)
+    finally:
+        for callback in shim.shutdown_callbacks:
+            callback()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
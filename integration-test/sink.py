@@ -1,3 +1,4 @@
+import gzip
 import json
 import threading
 from http.server import BaseHTTPRequestHandler, HTTPServer
@@ -12,6 +13,9 @@ def run_fake_ingest(metric_data):
     class FakeCollectdIngest(BaseHTTPRequestHandler):
         def do_POST(self):
             body = self.rfile.read(int(self.headers.get("Content-Length")))
+            # The plugin's OutputMode http sends gzipped batches
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
 
             metric_data.extend(json.loads(body))
 
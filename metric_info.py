@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import collections
+
 metric_default = [
     'nodes.cmd_get',
     'nodes.couch_docs_actual_disk_size',
@@ -255,3 +257,70 @@ metric_detailed = [
 ]
 
 metric_detailed.extend(['bucket.hot_keys.' + str(i) for i in range(11)])
+# Sent instead of the positional hot keys when HotKeys is set
+metric_detailed.append('bucket.hot_keys.ops')
+
+# collectd types (from types.db) used to dispatch the metrics
+GAUGE = 'gauge'
+COUNTER = 'counter'
+DERIVE = 'derive'
+
+# Metrics that are cumulative counters rather than gauges, sent as DERIVE so
+# that counter resets on node restarts are not read as wraparounds. The stats
+# of the Couchbase REST API are gauges or per-second rates sampled by
+# ns_server (e.g. cmd_get, get_hits, bytes_read), so every metric is sent as
+# a gauge unless listed here.
+metric_types = {}
+
+MetricSpec = collections.namedtuple('MetricSpec', ['name', 'type', 'default'])
+
+
+def build_registry():
+    """
+    Compiles the metric lists and types into one lookup table of MetricSpec
+    by metric name.
+    """
+    registry = {}
+    for names, default in ((metric_detailed, False), (metric_default, True)):
+        for name in names:
+            registry[name] = MetricSpec(name, metric_types.get(name, GAUGE), default)
+    return registry
+
+
+registry = build_registry()
+
+
+def _percent(part, total):
+    return 100.0 * part / total if total else None
+
+
+def _drain_time(queue, drain_rate):
+    return float(queue) / drain_rate if drain_rate else None
+
+
+def _delta(current, previous):
+    return current - previous
+
+
+# Metrics computed from other metrics sharing the same dimensions. The
+# formula is called with the current values of inputs followed by the values
+# of previous_inputs from the previous cycle, and may return None to skip
+# the value.
+DerivedMetric = collections.namedtuple('DerivedMetric', ['name', 'inputs', 'previous_inputs', 'formula', 'unit'])
+
+derived_metrics = [
+    # get_hits and cmd_get are per-second rates, so their ratio is the hit
+    # ratio of the sampled interval
+    DerivedMetric('derived.nodes.cache_hit_ratio', ('nodes.get_hits', 'nodes.cmd_get'), (), _percent, 'percent'),
+    DerivedMetric('derived.bucket.mem_high_wat_ratio', ('bucket.op.mem_used', 'bucket.op.ep_mem_high_wat'), (),
+                  _percent, 'percent'),
+    DerivedMetric('derived.bucket.disk_write_queue_drain_time',
+                  ('bucket.op.disk_write_queue', 'bucket.op.ep_diskqueue_drain'), (), _drain_time, 'seconds'),
+    DerivedMetric('derived.bucket.resident_ratio_delta', ('bucket.op.vb_active_resident_items_ratio',),
+                  ('bucket.op.vb_active_resident_items_ratio',), _delta, 'percent'),
+    DerivedMetric('derived.storage.ram_quota_utilization',
+                  ('storage.ram.quotaUsedPerNode', 'storage.ram.quotaTotalPerNode'), (), _percent, 'percent'),
+]
+
+# Metrics whose value is kept for the next cycle
+derived_previous_inputs = frozenset(name for derived in derived_metrics for name in derived.previous_inputs)
@@ -13227,3 +13227,7 @@ bucket_stat_10_1_12_33_3000 = {
 
 bucket_stat_10_1_7_181_3000 = bucket_stat_10_1_12_33_3000
 bucket_stat_10_1_8_152_3000 = bucket_stat_10_1_12_33_3000
+
+nodes_self = dict((key, value) for key, value in node["nodes"][2].items() if key != "thisNode")
+
+rebalance_progress = {"status": "none"}
@@ -5,10 +5,19 @@ Unit test for the Couchbase collectd plugin. Meant to be run with pytest.
 # Copyright (C) 2016 SignalFx, Inc.
 
 import collections
+import gzip
+import io
+import json
+import os
 import mock
+import six
+import socket
+import subprocess
 import sys
+import time
 import pytest
 
+import metric_info
 import sample_responses
 
 
@@ -27,7 +36,7 @@ class MockCollectd(mock.MagicMock):
     error = log
 
 
-def mock_api_call(url, opener):
+def mock_api_call(url, opener, timeout=None):
     """
     Returns example statistics from the sample_responses module.
 
@@ -46,6 +55,12 @@ def mock_api_call(url, opener):
     if parsed_url[-1] == 'nodes':
         key = 'bucket_nodes'
 
+    if parsed_url[-2] == 'nodes' and parsed_url[-1] == 'self':
+        key = 'nodes_self'
+
+    if parsed_url[-1] == 'rebalanceProgress':
+        key = 'rebalance_progress'
+
     if parsed_url[-1] == 'stats':
         node = parsed_url[-2]
         node = node.replace('.', '_')
@@ -57,6 +72,7 @@ def mock_api_call(url, opener):
 
 sys.modules['collectd'] = MockCollectd()
 import couchbase
+import couchbase_collect
 
 ConfigOption = collections.namedtuple('ConfigOption', ['key', 'values'])
 
@@ -214,3 +230,1297 @@ def test_read():
                                                testing="yes"))
     couchbase.read_bucket_stats(couchbase.config(mock_config_bucket,
                                                  testing="yes"))
+
+
+def _config_with(base_config, *options):
+    """
+    Returns a copy of a mock config with extra options appended
+    """
+    config = mock.Mock()
+    config.children = list(base_config.children) + list(options)
+    return config
+
+
+@mock.patch('couchbase._api_call', mock_api_call)
+def test_read_with_profiling(tmpdir):
+    """
+    Check that profiled cycles write pstats files and that the trigger file
+    re-arms profiling
+    """
+    trigger_file = tmpdir.join('profile.trigger')
+    module_config = couchbase.config(_config_with(mock_config_nodes,
+                                                  ConfigOption('ProfileCycles', ('1',)),
+                                                  ConfigOption('ProfileOutput', (str(tmpdir),)),
+                                                  ConfigOption('ProfileTracemalloc', (True,)),
+                                                  ConfigOption('ProfileTriggerFile', (str(trigger_file),))),
+                                     testing="yes")
+    assert module_config['profile']['cycles_left'] == 1
+
+    couchbase.read_with_profiling(module_config)
+    couchbase.read_with_profiling(module_config)
+    assert len(tmpdir.listdir(lambda p: p.ext == '.pstats')) == 1
+    assert len(tmpdir.listdir(lambda p: p.ext == '.txt')) == 1
+
+    trigger_file.write('2')
+    couchbase.read_with_profiling(module_config)
+    assert not trigger_file.exists()
+    assert module_config['profile']['cycles_left'] == 1
+    assert len(tmpdir.listdir(lambda p: p.ext == '.pstats')) == 2
+
+
+def test_config_profiling_disabled():
+    """
+    Check that profiling stays unwired when not configured
+    """
+    module_config = couchbase.config(mock_config_nodes, testing="yes")
+    assert module_config['profile'] is None
+    assert module_config['read_func'] is couchbase.read_node_stats
+
+
+@mock.patch('couchbase._api_call', mock_api_call)
+def test_standalone_runner():
+    """
+    Check that the standalone runner drives the read callbacks through its
+    collectd shim and reports per-phase timings
+    """
+    out = six.StringIO()
+    report = six.StringIO()
+    shim = couchbase_collect.CollectdShim(out=out, log=report)
+    config = couchbase_collect.build_config(['CollectTarget=NODE', 'Host=localhost', 'Port=3000',
+                                             'CollectMode=detailed'])
+    timer = couchbase_collect.PhaseTimer()
+    parse_metrics = couchbase._parse_metrics
+
+    with mock.patch('couchbase.collectd', shim):
+        timer.instrument(couchbase, phases=[('parse', '_parse_metrics')])
+        try:
+            couchbase.config(config)
+            couchbase_collect.run_cycles(shim, timer, 2, wait=False, report=report)
+        finally:
+            couchbase._parse_metrics = parse_metrics
+
+    values = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert values and all(v['plugin'] == 'couchbase' for v in values)
+    timings = [json.loads(line) for line in report.getvalue().splitlines()]
+    assert [t['cycle'] for t in timings] == [1, 2]
+    assert timings[0]['name'] == 'node_localhost:3000'
+    assert timings[0]['parse_calls'] == 1
+    assert timings[0]['values'] * 2 == len(values)
+
+
+def test_standalone_runner_stagger_start():
+    """
+    Check that the standalone runner waits for staggered Modules and still
+    reports per-phase timings. It runs in a fresh process, as main() imports
+    the plugin with its own collectd shim.
+    """
+    runner = subprocess.Popen(
+        [sys.executable, '-m', 'couchbase_collect', 'CollectTarget=NODE', 'Host=127.0.0.1', 'Port=1', 'Interval=1',
+         'StaggerStart=true', 'FailoverPeers=0', '--no-wait'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = runner.communicate()
+    assert runner.returncode == 0, err
+    timings = [json.loads(line) for line in err.decode('utf-8').splitlines() if line.startswith('{')]
+    assert [t['cycle'] for t in timings] == [1]
+    assert timings[0]['name'] == 'node_127.0.0.1:1'
+    assert timings[0]['fetch_calls'] >= 1
+
+
+def test_standalone_config_file(tmpdir):
+    """
+    Check parsing of Module config lines for the standalone runner
+    """
+    config_file = tmpdir.join('module.conf')
+    config_file.write('<Module couchbase>\n'
+                      '  CollectTarget "NODE"\n'
+                      '  Interval 10\n'
+                      '  # a comment\n'
+                      '  ProfileTracemalloc true\n'
+                      '</Module>\n')
+    config = couchbase_collect.build_config(['Port=8091'], str(config_file))
+    assert [(c.key, c.values) for c in config.children] == [
+        ('CollectTarget', ('NODE',)),
+        ('Interval', (10.0,)),
+        ('ProfileTracemalloc', (True,)),
+        ('Port', ('8091',)),
+    ]
+
+
+def test_read_callback_skips_in_flight_cycle():
+    """
+    Check that a cycle is skipped, not stacked, while the previous one of the
+    same module still runs
+    """
+    module_config = couchbase.config(mock_config_nodes, testing="yes")
+    module_config['read_func'] = mock.Mock()
+    state = module_config['cycle_state']
+
+    state['lock'].acquire()
+    couchbase.read_callback(module_config)
+    state['lock'].release()
+    assert state['skipped'] == 1
+    assert not module_config['read_func'].called
+
+    couchbase.read_callback(module_config)
+    module_config['read_func'].assert_called_once_with(module_config)
+
+
+def test_cycle_schedule_stretch_and_recovery():
+    """
+    Check that repeated overruns stretch the effective interval and that it
+    shrinks back once cycles finish in time
+    """
+    state = couchbase.config(mock_config_nodes, testing="yes")['cycle_state']
+    for i in range(3):
+        couchbase._update_cycle_schedule(state, 100.0, 12.0, 10.0)
+    assert state['stretch'] == 2
+    assert state['next_due'] == 115.0
+
+    module_config = couchbase.config(mock_config_nodes, testing="yes")
+    module_config['cycle_state'] = state
+    module_config['read_func'] = mock.Mock()
+    with mock.patch('couchbase.time.time', return_value=110.0):
+        couchbase.read_callback(module_config)
+    assert state['skipped'] == 1
+    assert not module_config['read_func'].called
+
+    for i in range(3):
+        couchbase._update_cycle_schedule(state, 200.0, 1.0, 10.0)
+    assert state['stretch'] == 1
+    assert state['next_due'] == 0.0
+
+
+def test_staggered_start():
+    """
+    Check that staggered modules get a deterministic offset within the
+    interval and are registered from init()
+    """
+    module_config = couchbase.config(_config_with(mock_config_nodes, ConfigOption('StaggerStart', (True,))),
+                                     testing="yes")
+    offset = module_config['start_offset']
+    assert 0 <= offset < 10
+    assert offset == couchbase._start_offset('node_localhost:3000', 10.0, True, 0)
+    assert offset != couchbase._start_offset('node_otherhost:3000', 10.0, True, 0)
+    assert offset <= couchbase._start_offset('node_localhost:3000', 10.0, True, 2.0) <= offset + 2.0
+
+    with mock.patch('couchbase.threading.Timer') as timer:
+        couchbase.DEFERRED_READS.append(module_config)
+        couchbase.init()
+        timer.assert_called_once_with(offset, couchbase._register_read, args=(module_config,))
+        couchbase.shutdown()
+    assert couchbase.DEFERRED_READS == []
+    assert couchbase.STAGGER_TIMERS == []
+
+
+def test_circuit_breaker():
+    """
+    Check that the breaker opens after consecutive failures, probes with
+    exponential backoff and closes again on success
+    """
+    breaker = couchbase.CircuitBreaker(threshold=2, backoff=10, max_backoff=30)
+    assert breaker.record_failure(now=100) is True
+    assert breaker.allow(now=100)
+    assert breaker.record_failure(now=100) is True
+    assert breaker.state == couchbase.CircuitBreaker.OPEN
+    assert not breaker.allow(now=105)
+
+    assert breaker.allow(now=110)
+    assert breaker.state == couchbase.CircuitBreaker.HALF_OPEN
+    assert not breaker.allow(now=110)
+    assert breaker.record_failure(now=110) is False
+    assert breaker.next_probe == 130
+    assert breaker.allow(now=130)
+    breaker.record_failure(now=130)
+    assert breaker.next_probe == 160
+
+    assert breaker.allow(now=160)
+    breaker.record_success()
+    assert breaker.state == couchbase.CircuitBreaker.CLOSED
+    assert breaker.failures == 0
+    assert breaker.backoff == 10
+
+
+def test_api_call_circuit_open():
+    """
+    Check that calls to a host with an open circuit are refused without a
+    request, and that a failing host does not break the read callback
+    """
+    module_config = couchbase.config(_config_with(mock_config_nodes,
+                                                  ConfigOption('Host', ('deadhost',)),
+                                                  ConfigOption('CircuitBreakerThreshold', ('1',))),
+                                     testing="yes")
+    breaker = module_config['breaker']
+    assert breaker is couchbase.BREAKERS['http://deadhost:3000']
+    with mock.patch.object(module_config['opener'], 'open', side_effect=couchbase.socket.error('down')) as urlopen:
+        couchbase.read_node_stats(module_config)
+        assert urlopen.call_count == 1
+        assert breaker.state == couchbase.CircuitBreaker.OPEN
+        assert couchbase._api_call('http://deadhost:3000/pools/default', module_config['opener']) is None
+        assert urlopen.call_count == 1
+    del couchbase.BREAKERS['http://deadhost:3000']
+
+
+def test_api_call_client_errors_keep_circuit_closed():
+    """
+    Check that 4xx answers and unparsable bodies do not open the circuit the
+    Modules of a host share, while 5xx answers do
+    """
+    module_config = couchbase.config(_config_with(mock_config_bucket,
+                                                  ConfigOption('Host', ('busyhost',)),
+                                                  ConfigOption('CircuitBreakerThreshold', ('1',))),
+                                     testing="yes")
+    breaker = module_config['breaker']
+    url = 'http://busyhost:3000/pools/default/buckets/missing'
+
+    def http_error(code):
+        return couchbase.urllib.error.HTTPError(url, code, 'error', {}, None)
+
+    try:
+        for error in (http_error(404), http_error(401), ValueError('not json')):
+            with mock.patch.object(module_config['opener'], 'open', side_effect=error):
+                assert couchbase._api_call(url, module_config['opener']) is None
+            assert breaker.state == couchbase.CircuitBreaker.CLOSED
+        with mock.patch.object(module_config['opener'], 'open', side_effect=http_error(503)):
+            assert couchbase._api_call(url, module_config['opener']) is None
+        assert breaker.state == couchbase.CircuitBreaker.OPEN
+    finally:
+        del couchbase.BREAKERS['http://busyhost:3000']
+
+
+def test_seed_failover():
+    """
+    Check that calls fail over to a known peer when the seed node fails, that
+    the seed keeps its node identity and that the seed is preferred again
+    once it recovers
+    """
+    module_config = couchbase.config(mock_config_nodes, testing="yes")
+    seed_url = module_config['base_url']
+    cluster = module_config['cluster']
+    calls = []
+
+    def api_call(url, opener, timeout=None):
+        calls.append(url)
+        if url.startswith(seed_url) and seed_down:
+            return None
+        return mock_api_call(url, opener, timeout)
+
+    seed_down = False
+    with mock.patch('couchbase._api_call', api_call), \
+            mock.patch('couchbase._parse_and_post_metrics') as parse_and_post:
+        couchbase.read_node_stats(module_config)
+        assert cluster['this_node'] == '10.1.8.152:3000'
+        assert sorted(cluster['peers']) == ['http://10.1.12.33:3000', 'http://10.1.7.181:3000']
+        cluster['latency']['http://10.1.12.33:3000'] = 0.5
+        cluster['latency']['http://10.1.7.181:3000'] = 0.1
+
+        seed_down = True
+        del calls[:]
+        couchbase.read_node_stats(module_config)
+        assert calls == [seed_url + '/pools/default', 'http://10.1.7.181:3000/pools/default']
+        assert cluster['failovers'] == 1
+        resp_obj = parse_and_post.call_args[0][0]
+        this_nodes = [node['hostname'] for node in resp_obj['nodes'] if node.get('thisNode')]
+        assert this_nodes == ['10.1.8.152:3000']
+        assert cluster['latency'][seed_url] == float('inf')
+
+        seed_down = False
+        del calls[:]
+        couchbase.read_node_stats(module_config)
+        assert calls == [seed_url + '/pools/default']
+
+
+def test_hedged_api_call():
+    """
+    Check that a slow seed request is hedged to a peer, that the first
+    response wins and that hedging is bounded by HedgeMaxRatio
+    """
+    module_config = couchbase.config(_config_with(mock_config_bucket,
+                                                  ConfigOption('HedgeRequests', (True,)),
+                                                  ConfigOption('HedgeMaxRatio', ('0.5',))),
+                                     testing="yes")
+    seed_url = module_config['base_url']
+    peer_url = 'http://10.1.7.181:3000'
+    cluster = module_config['cluster']
+    cluster['peers'] = [peer_url]
+    cluster['seed_latencies'].extend([0.01] * couchbase.HEDGE_MIN_SAMPLES)
+
+    def api_call(url, opener, timeout=None):
+        if url.startswith(seed_url):
+            time.sleep(0.2)
+            return {'from': 'seed'}
+        return {'from': 'peer'}
+
+    with mock.patch('couchbase._api_call', api_call):
+        resp_obj, base_url = couchbase._hedged_api_call(module_config, 'pools/default/buckets/default')
+        assert resp_obj == {'from': 'peer'}
+        assert base_url == peer_url
+        assert module_config['hedge']['hedged'] == 1
+        assert module_config['hedge']['wins'] == 1
+        # The seed is recorded with the time it was waited for, not once its
+        # abandoned request completes
+        latencies = list(cluster['seed_latencies'])
+        assert len(latencies) == couchbase.HEDGE_MIN_SAMPLES + 1 and latencies[-1] < 0.2
+        time.sleep(0.3)
+        assert list(cluster['seed_latencies']) == latencies
+
+        resp_obj, base_url = couchbase._hedged_api_call(module_config, 'pools/default/buckets/default')
+        assert resp_obj == {'from': 'seed'}
+        assert module_config['hedge']['hedged'] == 1
+        assert module_config['hedge']['eligible'] == 2
+
+
+def test_hedged_api_call_survives_failing_requests():
+    """
+    Check that a hedged call returns when a request raises or never answers
+    instead of waiting for it forever
+    """
+    module_config = couchbase.config(_config_with(mock_config_bucket,
+                                                  ConfigOption('HedgeRequests', (True,)),
+                                                  ConfigOption('HedgeMaxRatio', ('1',)),
+                                                  ConfigOption('Timeout', ('0.2',))),
+                                     testing="yes")
+    seed_url = module_config['base_url']
+    cluster = module_config['cluster']
+    cluster['peers'] = ['http://10.1.7.181:3000']
+    cluster['seed_latencies'].extend([0.01] * couchbase.HEDGE_MIN_SAMPLES)
+
+    def raising_seed(url, opener, timeout=None):
+        if url.startswith(seed_url):
+            time.sleep(0.05)
+            raise couchbase.http_client.IncompleteRead(b'')
+        return None
+
+    def hanging_seed(url, opener, timeout=None):
+        if url.startswith(seed_url):
+            time.sleep(2)
+        return None
+
+    for api_call in (raising_seed, hanging_seed):
+        cluster['latency'].clear()
+        start = time.time()
+        with mock.patch('couchbase._api_call', api_call):
+            assert couchbase._hedged_api_call(module_config, 'pools/default/buckets/default') == (None, None)
+        assert time.time() - start < 1
+
+    opener = mock.Mock()
+    opener.open.side_effect = couchbase.http_client.BadStatusLine('')
+    assert couchbase._api_call('http://127.0.0.1:1/pools/default', opener) is None
+
+
+def test_percentile():
+    assert couchbase._percentile(range(1, 101), 95) == 95
+    assert couchbase._percentile([3, 1, 2], 50) == 2
+    assert couchbase._percentile([5], 0) == 5
+
+
+@mock.patch('couchbase._api_call', mock_api_call)
+def test_read_collect_all_nodes():
+    """
+    Check that CollectAllNodes emits per-node metrics for every node of the
+    cluster from one collector, each with its own node dimension
+    """
+    for base_config, read in ((mock_config_nodes, couchbase.read_node_stats),
+                              (mock_config_bucket, couchbase.read_bucket_stats)):
+        module_config = couchbase.config(_config_with(base_config, ConfigOption('CollectAllNodes', (True,))),
+                                         testing="yes")
+        with mock.patch('couchbase._post_metrics') as post_metrics:
+            read(module_config)
+        nodes = set(metric.dimensions.get('node')
+                    for call in post_metrics.call_args_list for metric in call[0][0]) - {None}
+        assert nodes == {'10.1.12.33:3000', '10.1.7.181:3000', '10.1.8.152:3000'}
+        assert 'node' not in module_config['dimensions']
+
+
+def test_collect_all_nodes_bucket_refreshes_membership():
+    """
+    Check that a BUCKET Module with CollectAllNodes still learns its failover
+    peers and the rebalance state without fetching pools/default every cycle
+    """
+    module_config = couchbase.config(_config_with(mock_config_bucket,
+                                                  ConfigOption('CollectAllNodes', (True,)),
+                                                  ConfigOption('AdaptivePolling', (True,))),
+                                     testing="yes")
+    fetched = []
+
+    def api_call(url, opener, timeout=None):
+        fetched.append(url.split('/', 3)[-1])
+        if url.endswith('rebalanceProgress'):
+            return {'status': 'running'}
+        return mock_api_call(url, opener, timeout)
+
+    with mock.patch('couchbase._api_call', api_call), mock.patch('couchbase._post_metrics'):
+        couchbase.read_bucket_stats(module_config)
+        assert fetched.count('pools/default') == 1
+        assert len(module_config['cluster']['peers']) == 2
+        for group in module_config['group_schedule'].values():
+            group['next_due'] = 0.0
+        couchbase.read_bucket_stats(module_config)
+    assert fetched.count('pools/default') == 1
+    assert fetched.count('pools/default/rebalanceProgress') == 1
+    assert module_config['adaptive']['rebalancing'] is True
+
+
+def test_rendezvous_owner():
+    """
+    Check that cluster-wide work is spread across the nodes and that only the
+    work of a leaving node moves
+    """
+    nodes = ['node%d:8091' % i for i in range(5)]
+    keys = [('bucket%d' % i, 'pools/default/buckets') for i in range(200)]
+    owners = dict((key, couchbase._rendezvous_owner(key, nodes)) for key in keys)
+    assert set(owners.values()) == set(nodes)
+    assert max(collections.Counter(owners.values()).values()) < 80
+
+    remaining = [node for node in nodes if node != 'node2:8091']
+    for key, owner in owners.items():
+        new_owner = couchbase._rendezvous_owner(key, remaining)
+        if owner != 'node2:8091':
+            assert new_owner == owner
+        assert couchbase._rendezvous_owner(key, list(reversed(remaining))) == new_owner
+
+
+@mock.patch('couchbase._api_call', mock_api_call)
+def test_read_shard_cluster_work():
+    """
+    Check that with ShardClusterWork the cluster-wide bucket stats are only
+    fetched by the node owning the bucket
+    """
+    module_config = couchbase.config(_config_with(mock_config_bucket, ConfigOption('ShardClusterWork', (True,))),
+                                     testing="yes")
+    owner = couchbase._rendezvous_owner(('default', 'pools/default/buckets'),
+                                        ['10.1.12.33:3000', '10.1.7.181:3000', '10.1.8.152:3000'])
+    with mock.patch('couchbase._parse_and_post_metrics') as parse_and_post:
+        couchbase.read_bucket_stats(module_config)
+    request_types = [call[0][1] for call in parse_and_post.call_args_list]
+    assert (couchbase.REQUEST_TYPE_BUCKET in request_types) == (owner == '10.1.8.152:3000')
+    assert couchbase.REQUEST_TYPE_BUCKET_STAT in request_types
+
+
+@mock.patch('couchbase._api_call', mock_api_call)
+def test_shard_cluster_work_reports_owner_as_leader():
+    """
+    Check that with ShardClusterWork plugin.leader is posted by the collector
+    emitting the storage totals rather than by the node sorting first
+    """
+    module_config = couchbase.config(_config_with(mock_config_nodes, ConfigOption('ShardClusterWork', (True,))),
+                                     testing="yes")
+    posted = {}
+    with mock.patch('couchbase._rendezvous_owner', return_value='10.1.8.152:3000'), \
+            mock.patch('couchbase._post_metrics') as post_metrics, \
+            mock.patch('couchbase._post_self_metrics', side_effect=lambda values, config: posted.update(values)):
+        couchbase.read_callback(module_config)
+    assert module_config['leader'].leader == '10.1.12.33:3000'
+    names = set(metric.name for call in post_metrics.call_args_list for metric in call[0][0])
+    assert 'storage.hdd.total' in names
+    assert posted['leader'] == 1
+
+
+def test_leader_election():
+    """
+    Check that only the first node in sorted order leads, that the result is
+    cached per membership and that a missing thisNode falls back to the
+    known hostname
+    """
+    nodes_obj = sample_responses.node
+    election = couchbase.LeaderElection()
+    assert election.update(nodes_obj) is False
+    assert election.this_node == '10.1.8.152:3000'
+    assert election.leader == '10.1.12.33:3000'
+
+    with mock.patch('couchbase._rendezvous_owner', wraps=couchbase._rendezvous_owner) as owner:
+        election.owns(('default', 'pools/default/buckets'))
+        election.owns(('default', 'pools/default/buckets'))
+        assert election.update(nodes_obj) is False
+        assert owner.call_count == 1
+
+    without_this_node = {'nodes': [{'hostname': node['hostname']} for node in nodes_obj['nodes']]}
+    election = couchbase.LeaderElection()
+    assert election.update(without_this_node) is False
+    assert election.this_node is None
+    assert not election.owns(('default', 'pools/default/buckets'))
+    assert election.update(without_this_node, (None, '10.1.12.33:3000')) is True
+
+
+@mock.patch('couchbase._api_call', mock_api_call)
+def test_read_node_stats_not_leader():
+    """
+    Check that cluster-wide storage metrics are only emitted by the leader
+    """
+    module_config = couchbase.config(mock_config_nodes, testing="yes")
+    with mock.patch('couchbase._parse_and_post_metrics') as parse_and_post:
+        couchbase.read_node_stats(module_config)
+    assert [call[0][1] for call in parse_and_post.call_args_list] == [couchbase.REQUEST_TYPE_NODE_STAT]
+    assert module_config['leader'].is_leader is False
+
+
+def test_read_node_stats_nodes_self():
+    """
+    Check that NODE mode fetches nodes/self for per-node metrics when the
+    cluster-wide storage totals are not collected
+    """
+    module_config = couchbase.config(_config_with(mock_config_nodes, ConfigOption('CollectMode', ('default',))),
+                                     testing="yes")
+    assert module_config['cluster_stats_wanted'] is False
+    assert couchbase.config(mock_config_nodes, testing="yes")['cluster_stats_wanted'] is True
+
+    api_call = mock.Mock(side_effect=mock_api_call)
+    with mock.patch('couchbase._api_call', api_call), mock.patch('couchbase._post_metrics') as post_metrics:
+        couchbase.read_node_stats(module_config)
+        couchbase.read_node_stats(module_config)
+    urls = [call[0][0] for call in api_call.call_args_list]
+    assert urls == ['http://localhost:3000/pools/default', 'http://localhost:3000/nodes/self']
+    first, second = [set((m.name, m.dimensions['node']) for m in call[0][0]) for call in post_metrics.call_args_list]
+    assert first == second
+    assert ('nodes.system.mem_total', '10.1.8.152:3000') in second
+
+
+def test_group_intervals():
+    """
+    Check that metric groups are fetched at their own interval and that the
+    read callback runs at the shortest one
+    """
+    module_config = couchbase.config(_config_with(mock_config_bucket,
+                                                  ConfigOption('Interval', ('60',)),
+                                                  ConfigOption('IntervalBucketOps', ('10',))),
+                                     testing="yes")
+    assert module_config['read_interval'] == 10.0
+    assert couchbase._due_groups(module_config, now=1000.0) == {'BucketBasic', 'BucketOps'}
+    couchbase._schedule_group(module_config, 'BucketBasic', 1000.0)
+    assert couchbase._due_groups(module_config, now=1010.1) == {'BucketOps'}
+    assert couchbase._due_groups(module_config, now=1058.0) == {'BucketOps', 'BucketBasic'}
+
+    with pytest.raises(ValueError):
+        couchbase.config(_config_with(mock_config_bucket, ConfigOption('IntervalStorage', ('300',))),
+                         testing="yes")
+
+
+def test_group_retried_after_failed_fetch():
+    """
+    Check that a slow group whose fetch failed is fetched again in the next
+    cycle rather than after its interval
+    """
+    module_config = couchbase.config(_config_with(mock_config_bucket,
+                                                  ConfigOption('Interval', ('300',)),
+                                                  ConfigOption('IntervalBucketOps', ('10',))),
+                                     testing="yes")
+    module_config['leader'].update = mock.Mock(return_value=True)
+    module_config['leader'].is_leader = True
+    module_config['leader'].this_node = '10.1.8.152:3000'
+
+    def failing_bucket_call(url, opener, timeout=None):
+        if url.endswith('/buckets/default'):
+            return None
+        return mock_api_call(url, opener, timeout)
+
+    with mock.patch('couchbase._parse_and_post_metrics') as parse_and_post:
+        with mock.patch('couchbase._api_call', failing_bucket_call):
+            couchbase.read_bucket_stats(module_config)
+        assert couchbase._due_groups(module_config, now=couchbase.time.time() + 20) == {'BucketBasic', 'BucketOps'}
+        with mock.patch('couchbase._api_call', mock_api_call):
+            couchbase.read_bucket_stats(module_config)
+        assert couchbase._due_groups(module_config, now=couchbase.time.time() + 20) == {'BucketOps'}
+    request_types = [call[0][1] for call in parse_and_post.call_args_list]
+    assert request_types.count(couchbase.REQUEST_TYPE_BUCKET) == 1
+
+
+@mock.patch('couchbase._api_call', mock_api_call)
+def test_read_node_stats_storage_interval():
+    """
+    Check that storage totals are only fetched when their group is due
+    """
+    module_config = couchbase.config(_config_with(mock_config_nodes, ConfigOption('IntervalStorage', ('300',))),
+                                     testing="yes")
+    module_config['leader'].update = mock.Mock(return_value=True)
+    module_config['leader'].is_leader = True
+    with mock.patch('couchbase._parse_and_post_metrics') as parse_and_post:
+        couchbase.read_node_stats(module_config)
+        module_config['cluster']['refreshed'] = couchbase.time.time()
+        couchbase.read_node_stats(module_config)
+    request_types = [call[0][1] for call in parse_and_post.call_args_list]
+    assert request_types == [couchbase.REQUEST_TYPE_NODE, couchbase.REQUEST_TYPE_NODE_STAT,
+                             couchbase.REQUEST_TYPE_NODE_STAT]
+
+
+def test_adaptive_polling():
+    """
+    Check that high API latency or a rebalance stretches the interval and
+    drops detailed metrics until the pressure is gone
+    """
+    module_config = couchbase.config(_config_with(mock_config_nodes,
+                                                  ConfigOption('AdaptivePolling', (True,)),
+                                                  ConfigOption('AdaptiveLatencyThreshold', ('1',))),
+                                     testing="yes")
+    adaptive = module_config['adaptive']
+    state = module_config['cycle_state']
+    assert couchbase._is_metric_name_allowed('storage.hdd.total', module_config)
+
+    def api_call(url, opener, timeout=None):
+        time.sleep(0.01)
+        return dict(sample_responses.node, rebalanceStatus='running')
+
+    with mock.patch('couchbase._api_call', api_call):
+        couchbase._get_cluster_nodes(module_config)
+    assert adaptive['rebalancing'] is True
+    assert 0 < adaptive['latency'] < 1
+
+    couchbase._update_pressure(adaptive, state)
+    couchbase._update_pressure(adaptive, state)
+    assert state['pressure_stretch'] == 4
+    assert adaptive['under_pressure']
+    assert not couchbase._is_metric_name_allowed('storage.hdd.total', module_config)
+    couchbase._update_cycle_schedule(state, 100.0, 1.0, 10.0)
+    assert state['next_due'] == 135.0
+
+    adaptive['rebalancing'] = False
+    couchbase._update_pressure(adaptive, state)
+    assert adaptive['under_pressure']
+    couchbase._update_pressure(adaptive, state)
+    assert state['pressure_stretch'] == 1
+    assert not adaptive['under_pressure']
+    assert couchbase._is_metric_name_allowed('storage.hdd.total', module_config)
+
+
+def test_adaptive_polling_sees_rebalance_on_nodes_self():
+    """
+    Check that AdaptivePolling notices a rebalance when only nodes/self is
+    fetched, as happens with FailoverPeers 0
+    """
+    module_config = couchbase.config(_config_with(mock_config_nodes,
+                                                  ConfigOption('AdaptivePolling', (True,)),
+                                                  ConfigOption('FailoverPeers', ('0',))),
+                                     testing="yes")
+    adaptive = module_config['adaptive']
+    state = module_config['cycle_state']
+    fetched = []
+
+    def api_call(url, opener, timeout=None):
+        fetched.append(url.split('/', 3)[-1])
+        if url.endswith('rebalanceProgress'):
+            return {'status': 'running'}
+        return mock_api_call(url, opener, timeout)
+
+    with mock.patch('couchbase._api_call', api_call):
+        resp = couchbase._get_this_node(module_config)
+    assert resp['nodes'][0]['thisNode']
+    assert 'pools/default' not in fetched
+    assert adaptive['rebalancing'] is True
+    couchbase._update_pressure(adaptive, state)
+    assert adaptive['under_pressure']
+
+    with mock.patch('couchbase._api_call', mock_api_call):
+        couchbase._get_this_node(module_config)
+    assert adaptive['rebalancing'] is False
+
+
+def test_api_call_uses_module_opener():
+    """
+    Check that each module's opener and timeout are used directly, without
+    installing a process-global opener
+    """
+    first = couchbase.config(_config_with(mock_config_field_length, ConfigOption('Timeout', ('5',))), testing="yes")
+    second = couchbase.config(mock_config_bucket, testing="yes")
+    response = six.BytesIO(b'{"ok": true}')
+    with mock.patch.object(first['opener'], 'open', return_value=response) as first_open, \
+            mock.patch.object(second['opener'], 'open') as second_open, \
+            mock.patch('couchbase.urllib.request.install_opener') as install_opener:
+        resp_obj = couchbase._timed_api_call(first, first['base_url'], 'pools/default')
+    assert resp_obj == {'ok': True}
+    first_open.assert_called_once_with('http://localhost:3000/pools/default', timeout=5.0)
+    assert not second_open.called
+    assert not install_opener.called
+    assert second['http_timeout'] == couchbase.DEFAULT_API_TIMEOUT
+
+
+def test_suppress_unchanged():
+    """
+    Check that unchanged values are suppressed and re-sent every
+    HeartbeatIntervals cycles
+    """
+    module_config = couchbase.config(_config_with(mock_config_nodes,
+                                                  ConfigOption('SuppressUnchanged', (True,)),
+                                                  ConfigOption('HeartbeatIntervals', ('3',))),
+                                     testing="yes")
+    dispatched = []
+    values = [1, 1, 1, 1, 2, 2, 1]
+    with mock.patch('couchbase.collectd.Values') as values_class:
+        values_class.return_value.dispatch.side_effect = lambda: dispatched.append(values_class.return_value.values)
+        for value in values:
+            couchbase._post_metrics([couchbase.Metric('nodes.mem_total', value, {'node': 'a'}),
+                                     couchbase.Metric('nodes.mem_total', 7, {'node': 'b'})], module_config)
+    assert [d[0] for d in dispatched if d[0] != 7] == [1, 1, 2, 1]
+    assert len([d for d in dispatched if d[0] == 7]) == 3
+    assert module_config['suppression']['suppressed'] == 3 + 4
+    assert len(module_config['suppression']['series']) == 2
+
+
+def test_suppression_evicts_gone_series():
+    """
+    Check that series not seen for HeartbeatIntervals cycles are no longer
+    tracked for suppression
+    """
+    module_config = couchbase.config(_config_with(mock_config_nodes,
+                                                  ConfigOption('SuppressUnchanged', (True,)),
+                                                  ConfigOption('HeartbeatIntervals', ('3',))),
+                                     testing="yes")
+    suppression = module_config['suppression']
+    assert suppression['idle_after'] == 4 * 10
+    assert not couchbase._is_unchanged(suppression, ('nodes.mem_total', 'a'), 1, 100.0)
+    assert not couchbase._is_unchanged(suppression, ('nodes.mem_total', 'b'), 1, 100.0)
+    for cycle in range(1, 4):
+        assert couchbase._is_unchanged(suppression, ('nodes.mem_total', 'a'), 1, 100.0 + 10 * cycle) == (cycle < 3)
+    assert list(suppression['series']) == [('nodes.mem_total', 'b'), ('nodes.mem_total', 'a')]
+    assert couchbase._is_unchanged(suppression, ('nodes.mem_total', 'a'), 1, 140.0)
+    assert list(suppression['series']) == [('nodes.mem_total', 'a')]
+    assert suppression['evicted'] == 1
+
+
+def test_metric_registry():
+    """
+    Check that the registry carries the type and default flag per metric and
+    that counters are dispatched with their collectd type
+    """
+    spec = metric_info.registry['nodes.cmd_get']
+    assert (spec.type, spec.default) == ('gauge', True)
+    assert metric_info.registry['bucket.op.bytes_read'].type == 'gauge'
+    assert metric_info.registry['storage.hdd.total'] == metric_info.MetricSpec('storage.hdd.total', 'gauge', False)
+    assert len(metric_info.registry) == len(metric_info.metric_default) + len(metric_info.metric_detailed)
+
+    module_config = couchbase.config(mock_config_nodes, testing="yes")
+    metric = couchbase._process_metric('nodes', 'cmd_get', 12.5, {}, module_config)
+    assert metric.type == 'gauge'
+    assert couchbase._process_metric('nodes', 'unknown', 1, {}, module_config) is None
+    with mock.patch('couchbase.collectd.Values') as values_class:
+        couchbase._post_metrics([metric], module_config)
+    assert values_class.return_value.type == 'gauge'
+    assert values_class.return_value.values == (12.5,)
+
+    # Metrics registered as counters are dispatched with their type
+    with mock.patch.dict(metric_info.registry, {'nodes.cmd_get': spec._replace(type='derive')}):
+        metric = couchbase._process_metric('nodes', 'cmd_get', 12.0, {}, module_config)
+    assert metric.type == 'derive'
+    with mock.patch('couchbase.collectd.Values') as values_class:
+        couchbase._post_metrics([metric], module_config)
+    assert values_class.return_value.type == 'derive'
+    assert values_class.return_value.values == (12,)
+
+
+def test_counter_rates():
+    """
+    Check that counters are converted to per-second rates, that resets and
+    node restarts only set a new baseline and that counter types wrap around
+    """
+    counter = metric_info.registry['nodes.cmd_get']._replace(type='derive')
+    with mock.patch.dict(metric_info.registry, {'nodes.cmd_get': counter}):
+        module_config = couchbase.config(_config_with(mock_config_nodes, ConfigOption('CounterRates', ('both',))),
+                                         testing="yes")
+
+    def convert(value, now, metric_type='derive', node='a'):
+        metrics = [couchbase.Metric('nodes.cmd_get', value, {'node': node}, metric_type),
+                   couchbase.Metric('nodes.mem_total', 5, {'node': node})]
+        return dict((m.name, m.value) for m in couchbase._convert_counters(metrics, module_config, now))
+
+    assert convert(100, 10.0) == {'nodes.cmd_get': 100, 'nodes.mem_total': 5}
+    assert convert(150, 20.0)['nodes.cmd_get.rate'] == 5.0
+    assert 'nodes.cmd_get.rate' not in convert(30, 30.0)
+    assert module_config['counter_rates']['resets'] == 1
+    assert convert(60, 40.0)['nodes.cmd_get.rate'] == 3.0
+    assert convert(2 ** 32 - 10, 50.0, 'counter', 'b') == {'nodes.cmd_get': 2 ** 32 - 10, 'nodes.mem_total': 5}
+    assert convert(10, 60.0, 'counter', 'b')['nodes.cmd_get.rate'] == 2.0
+
+    rates = module_config['counter_rates']
+    couchbase._check_node_restart(rates, 'a', '500')
+    couchbase._check_node_restart(rates, 'a', '600')
+    assert len(rates['series']) == 2
+    couchbase._check_node_restart(rates, 'a', '20')
+    assert list(rates['series']) == [('nodes.cmd_get', (('node', 'b'),))]
+
+    with mock.patch.dict(metric_info.registry, {'nodes.cmd_get': counter}):
+        module_config = couchbase.config(_config_with(mock_config_nodes, ConfigOption('CounterRates', ('rate',))),
+                                         testing="yes")
+    assert convert(100, 10.0) == {'nodes.mem_total': 5}
+    assert convert(110, 15.0) == {'nodes.cmd_get.rate': 2.0, 'nodes.mem_total': 5}
+    with pytest.raises(ValueError):
+        couchbase.config(_config_with(mock_config_nodes, ConfigOption('CounterRates', ('delta',))), testing="yes")
+
+
+def test_derived_metrics():
+    """
+    Check that derived metrics are computed per dimension set from the
+    current and previous values of their inputs
+    """
+    module_config = couchbase.config(_config_with(mock_config_bucket, ConfigOption('DerivedMetrics', (True,))),
+                                     testing="yes")
+
+    def derive(node, values):
+        metrics = [couchbase.Metric(name, value, {'node': node}) for name, value in values.items()]
+        return dict((m.name, m.value) for m in couchbase._derive_metrics(metrics, module_config))
+
+    assert derive('a', {'bucket.op.mem_used': 30, 'bucket.op.ep_mem_high_wat': 120,
+                        'bucket.op.disk_write_queue': 50, 'bucket.op.ep_diskqueue_drain': 0,
+                        'bucket.op.vb_active_resident_items_ratio': 90}) == {'derived.bucket.mem_high_wat_ratio': 25.0}
+    assert derive('a', {'bucket.op.disk_write_queue': 50, 'bucket.op.ep_diskqueue_drain': 10,
+                        'bucket.op.vb_active_resident_items_ratio': 85}) == {
+        'derived.bucket.disk_write_queue_drain_time': 5.0, 'derived.bucket.resident_ratio_delta': -5}
+    assert derive('b', {'bucket.op.vb_active_resident_items_ratio': 70}) == {}
+    assert derive('a', {'nodes.get_hits': 80, 'nodes.cmd_get': 100}) == {'derived.nodes.cache_hit_ratio': 80.0}
+    assert derive('a', {'nodes.get_hits': 30, 'nodes.cmd_get': 50}) == {'derived.nodes.cache_hit_ratio': 60.0}
+    assert derive('a', {'nodes.get_hits': 0, 'nodes.cmd_get': 0}) == {}
+
+    dispatched = []
+    with mock.patch('couchbase._api_call', mock_api_call), \
+            mock.patch('couchbase.collectd.Values') as values_class:
+        values_class.return_value.dispatch.side_effect = lambda: dispatched.append(
+            values_class.return_value.type_instance)
+        couchbase.read_bucket_stats(module_config)
+    assert 'derived.bucket.mem_high_wat_ratio' in dispatched
+
+
+def test_metric_filters():
+    """
+    Check that IncludeMetric adds metrics to the CollectMode, that
+    ExcludeMetric removes them and that decisions are memoized
+    """
+    module_config = couchbase.config(_config_with(mock_config_bucket,
+                                                  ConfigOption('CollectMode', ('default',)),
+                                                  ConfigOption('IncludeMetric', ('bucket.op.ep_dcp_*',)),
+                                                  ConfigOption('IncludeMetric', ('/bucket\\.hot_keys\\.[0-2]$/',)),
+                                                  ConfigOption('ExcludeMetric', ('*.ep_dcp_xdcr_*', 'bucket.op.ops'))),
+                                     testing="yes")
+    allowed = couchbase._is_metric_name_allowed
+    assert allowed('bucket.op.ep_dcp_replica_items_remaining', module_config)
+    assert not allowed('bucket.op.ep_dcp_xdcr_backoff', module_config)
+    assert not allowed('bucket.op.ep_tap_user_queue_fill', module_config)
+    assert allowed('bucket.hot_keys.2', module_config)
+    assert not allowed('bucket.hot_keys.10', module_config)
+    assert allowed('bucket.op.mem_used', module_config)
+    assert not allowed('bucket.op.ops', module_config)
+    assert not allowed('bucket.op.ep_dcp_unknown', module_config)
+    assert module_config['metric_filter']['selected']['bucket.op.ops'] is False
+    assert module_config['metric_filter']['selected']['bucket.op.mem_used'] is None
+
+    with mock.patch('couchbase._api_call', mock_api_call), \
+            mock.patch('couchbase.collectd.Values') as values_class:
+        couchbase.read_bucket_stats(module_config)
+    assert values_class.return_value.dispatch.called
+
+
+def test_hot_keys():
+    """
+    Check that the top HotKeys keys are sent with their name as a dimension
+    fitted to FieldLength, and that distinct key series are capped
+    """
+    module_config = couchbase.config(_config_with(mock_config_bucket,
+                                                  ConfigOption('HotKeys', ('2',)),
+                                                  ConfigOption('MaxHotKeySeries', ('2',)),
+                                                  ConfigOption('FieldLength', ('80',))),
+                                     testing="yes")
+    dimensions = {'bucket': 'default', 'node': 'n1'}
+    hot_keys = [{'name': 'user::1', 'ops': 5.0}, {'name': 'user::2', 'ops': 9.0},
+                {'name': 'doc,' + 'x' * 80, 'ops': 7.0}, {'name': 'user::4', 'ops': 1.0}]
+    metrics = couchbase._parse_hot_keys(hot_keys, dimensions, module_config, now=100.0)
+    assert [(m.name, m.value) for m in metrics] == [('bucket.hot_keys.ops', 9.0), ('bucket.hot_keys.ops', 7.0)]
+    assert metrics[0].dimensions == {'bucket': 'default', 'node': 'n1', 'key': 'user::2'}
+    long_key = metrics[1].dimensions['key']
+    assert long_key.startswith('doc_xxx') and '~' in long_key
+    plugin_instance = couchbase._format_dimensions(metrics[1].dimensions, 80)
+    assert len(plugin_instance) == 80 and plugin_instance == '[node=n1,bucket=default,key=%s]' % long_key
+
+    hot_keys.append({'name': 'user::5', 'ops': 20.0})
+    assert len(couchbase._parse_hot_keys(hot_keys, dimensions, module_config, now=105.0)) == 1
+    assert module_config['hot_keys']['dropped'] == 1
+    assert len(couchbase._parse_hot_keys(hot_keys, dimensions, module_config, now=200.0)) == 2
+    assert module_config['hot_keys']['evicted'] == 1
+    assert len(module_config['hot_keys']['series']) == 2
+
+
+def test_series_registry():
+    """
+    Check that series beyond MaxSeries are dropped, that idle series are
+    evicted and that self-metrics are not capped
+    """
+    registry = couchbase.SeriesRegistry(2, 3)
+    assert registry.admit('a', '[node=1]', 0.0, 10)
+    assert registry.admit('b', '[node=1]', 5.0, 10)
+    assert not registry.admit('c', '[node=1]', 10.0, 10)
+    assert registry.admit('a', '[node=1]', 20.0, 10)
+    assert registry.dropped == 1
+    # b was last sent at 5s and is idle after 3 cycles of 10s
+    assert registry.admit('c', '[node=1]', 36.0, 10)
+    assert registry.evicted == 1
+    assert list(registry.series) == [hash(('a', '[node=1]')), hash(('c', '[node=1]'))]
+
+    module_config = couchbase.config(_config_with(mock_config_nodes, ConfigOption('MaxSeries', ('3',))),
+                                     testing="yes")
+    assert module_config['series_registry'] is couchbase.SERIES_REGISTRY
+    try:
+        dispatched = []
+        with mock.patch('couchbase.collectd.Values') as values_class:
+            values_class.return_value.dispatch.side_effect = lambda: dispatched.append(
+                values_class.return_value.type_instance)
+            couchbase._post_metrics([couchbase.Metric('nodes.mem_used', i, {'node': str(i)}) for i in range(5)],
+                                    module_config)
+            couchbase._post_self_metrics({'leader': 1, 'cycles_skipped': 0}, module_config)
+        assert dispatched.count('nodes.mem_used') == 3
+        assert dispatched.count('plugin.leader') == 1
+        assert couchbase.SERIES_REGISTRY.dropped == 2
+    finally:
+        couchbase.SERIES_REGISTRY = None
+
+
+def test_series_registry_slow_groups():
+    """
+    Check that series of a metric group slower than the read interval are not
+    evicted between two of its fetches, even while the interval is stretched
+    """
+    module_config = couchbase.config(_config_with(mock_config_nodes,
+                                                  ConfigOption('MaxSeries', ('1',)),
+                                                  ConfigOption('SeriesIdleCycles', ('1',)),
+                                                  ConfigOption('IntervalStorage', ('300',))),
+                                     testing="yes")
+    assert module_config['read_interval'] == 10
+    assert couchbase._series_interval(module_config) == 300
+    module_config['cycle_state']['stretch'] = 2
+    assert couchbase._series_interval(module_config) == 600
+    try:
+        with mock.patch('couchbase.collectd.Values'), mock.patch('couchbase.time.time', return_value=0.0):
+            couchbase._post_metrics([couchbase.Metric('storage.hdd.total', 1, {})], module_config)
+        with mock.patch('couchbase.collectd.Values'), mock.patch('couchbase.time.time', return_value=300.0):
+            couchbase._post_metrics([couchbase.Metric('storage.hdd.total', 1, {})], module_config)
+        assert couchbase.SERIES_REGISTRY.dropped == 0 and couchbase.SERIES_REGISTRY.evicted == 0
+    finally:
+        couchbase.SERIES_REGISTRY = None
+
+
+def test_dimension_transport_meta():
+    """
+    Check that DimensionTransport meta carries untruncated dimensions in meta
+    and that plugin_instance and meta are built once per dimension set
+    """
+    cluster = 'c' * 100
+    module_config = couchbase.config(_config_with(mock_config_nodes,
+                                                  ConfigOption('DimensionTransport', ('meta',)),
+                                                  ConfigOption('ClusterName', (cluster,))),
+                                     testing="yes")
+    dimensions = dict(module_config['dimensions'], node='10.1.8.152:3000')
+    with mock.patch('couchbase.collectd.Values') as values_class:
+        couchbase._post_metrics([couchbase.Metric('nodes.mem_used', 1, dimensions)], module_config)
+    datapoint = values_class.return_value
+    assert datapoint.meta['cluster'] == cluster
+    assert datapoint.meta['node'] == '10.1.8.152:3000'
+    assert len(datapoint.plugin_instance) == couchbase.SERIES_ID_LENGTH
+    assert couchbase._series_dimensions(dict(dimensions), module_config) == (datapoint.plugin_instance,
+                                                                             datapoint.meta)
+    assert couchbase._series_dimensions(dict(dimensions), module_config)[1] is datapoint.meta
+    other = couchbase._series_dimensions(dict(dimensions, node='10.1.7.181:3000'), module_config)
+    assert other[0] != datapoint.plugin_instance
+
+    module_config = couchbase.config(mock_config_nodes, testing="yes")
+    plugin_instance, meta = couchbase._series_dimensions(dimensions, module_config)
+    assert plugin_instance == couchbase._format_dimensions(dimensions, module_config['field_length'])
+    assert meta == {'0': True}
+    with pytest.raises(ValueError):
+        couchbase.config(_config_with(mock_config_nodes, ConfigOption('DimensionTransport', ('tags',))),
+                         testing="yes")
+
+
+def test_output_mode_http():
+    """
+    Check that OutputMode http sends the values of a cycle as one gzipped
+    write_http batch over a reused connection, retrying once on a new one
+    """
+    module_config = couchbase.config(_config_with(mock_config_nodes,
+                                                  ConfigOption('OutputMode', ('http',)),
+                                                  ConfigOption('IngestURL', ('http://ingest:8080/v1/collectd?a=b',)),
+                                                  ConfigOption('IngestUser', ('auth',)),
+                                                  ConfigOption('IngestPassword', ('token',))),
+                                     testing="yes")
+    requests = []
+
+    def request(method, path, body, headers):
+        requests.append((method, path, body, headers))
+
+    connection = mock.Mock()
+    connection.request.side_effect = request
+    connection.getresponse.return_value.status = 200
+    try:
+        with mock.patch('couchbase.http_client.HTTPConnection', return_value=connection) as connection_class, \
+                mock.patch('couchbase.collectd.Values') as values_class:
+            couchbase._post_metrics([couchbase.Metric('nodes.mem_used', 5, {'node': 'a'}),
+                                     couchbase.Metric('nodes.cmd_get', 7.0, {'node': 'a'}, 'derive')], module_config)
+            assert couchbase._flush_output(module_config)
+            couchbase._post_metrics([couchbase.Metric('nodes.mem_used', 6, {'node': 'a'})], module_config)
+            connection.request.side_effect = [six.moves.http_client.BadStatusLine(''), None]
+            assert couchbase._flush_output(module_config)
+            assert couchbase._flush_output(module_config)
+
+            connection.request.side_effect = None
+            connection.getresponse.return_value.status = 503
+            couchbase._post_metrics([couchbase.Metric('nodes.mem_used', 6, {'node': 'a'})], module_config)
+            assert not couchbase._flush_output(module_config)
+            assert module_config['output']['failures'] == 1
+        assert not values_class.return_value.dispatch.called
+        assert connection_class.call_count == 2
+        method, path, body, headers = requests[0]
+        assert (method, path) == ('POST', '/v1/collectd?a=b')
+        assert headers['Content-Encoding'] == 'gzip'
+        assert headers['Authorization'] == 'Basic YXV0aDp0b2tlbg=='
+        batch = json.loads(gzip.GzipFile(fileobj=io.BytesIO(body)).read().decode('utf-8'))
+        assert [(v['type_instance'], v['type'], v['values']) for v in batch] == [
+            ('nodes.mem_used', 'gauge', [5]), ('nodes.cmd_get', 'derive', [7])]
+        assert batch[0]['plugin'] == 'couchbase' and batch[0]['dsnames'] == ['value']
+        assert module_config['output']['batches'] == 2 and module_config['output']['values'] == 3
+    finally:
+        couchbase.INGEST_CONNECTIONS.clear()
+
+    with pytest.raises(ValueError):
+        couchbase.config(_config_with(mock_config_nodes, ConfigOption('OutputMode', ('http',))), testing="yes")
+
+
+def test_output_mode_http_slow_ingest():
+    """
+    Check that sending the batch counts towards the cycle duration, that the
+    ingest endpoint gets its own timeout and that a request failing on a new
+    connection is not retried
+    """
+    module_config = couchbase.config(_config_with(mock_config_nodes,
+                                                  ConfigOption('OutputMode', ('http',)),
+                                                  ConfigOption('IngestURL', ('http://ingest:8080/v1/collectd',)),
+                                                  ConfigOption('IngestTimeout', ('2',))),
+                                     testing="yes")
+    module_config['read_func'] = lambda config: couchbase._post_metrics(
+        [couchbase.Metric('nodes.mem_used', 5, {})], config)
+
+    def post_batch(output, body, timeout):
+        time.sleep(0.05)
+        return True
+
+    with mock.patch('couchbase._post_batch', side_effect=post_batch) as post, \
+            mock.patch('couchbase._update_cycle_schedule') as update_schedule:
+        couchbase.read_callback(module_config)
+    assert post.call_args[0][2] == 2.0
+    assert update_schedule.call_args[0][2] >= 0.05
+
+    connection = mock.Mock()
+    connection.request.side_effect = socket.error('unreachable')
+    try:
+        with mock.patch('couchbase.http_client.HTTPConnection', return_value=connection) as connection_class:
+            assert not couchbase._post_batch(module_config['output'], b'batch', 2.0)
+        connection_class.assert_called_once_with('ingest:8080', timeout=2.0)
+    finally:
+        couchbase.INGEST_CONNECTIONS.clear()
+
+
+def test_prometheus_exporter():
+    """
+    Check that the latest cycle of each Module is rendered once in the
+    Prometheus text format and served from the cached buffer
+    """
+    module_config = couchbase.config(_config_with(mock_config_nodes,
+                                                  ConfigOption('PrometheusPort', ('9500',)),
+                                                  ConfigOption('PrometheusAddress', ('127.0.0.1',))),
+                                     testing="yes")
+    exporter = module_config['prometheus']['exporter']
+    assert exporter is couchbase.PROMETHEUS_EXPORTERS[('127.0.0.1', 9500)]
+    try:
+        with mock.patch('couchbase.collectd.Values'):
+            couchbase._post_metrics([couchbase.Metric('nodes.mem_used', 5, {'node': 'a"b'}),
+                                     couchbase.Metric('nodes.cmd_get', 7, {'node': 'a"b'}, 'derive')], module_config)
+            couchbase._post_metrics([couchbase.Metric('nodes.mem_used', 6, {'node': 'c', 'x': None})], module_config)
+        samples = module_config['prometheus']['samples']
+        module_config['prometheus']['samples'] = []
+        assert module_config['prometheus']['stale_after'] == 20.0
+        exporter.publish('module1', samples, 20.0, now=0.0)
+        exporter.publish('module2', [('nodes.mem_used', 'gauge', {'node': 'd'}, float('nan'))], 20.0, now=0.0)
+        assert exporter.text.decode('utf-8').split('\n') == [
+            '# TYPE couchbase_nodes_mem_used gauge',
+            'couchbase_nodes_mem_used{node="a\\"b"} 5.0',
+            'couchbase_nodes_mem_used{node="c"} 6.0',
+            'couchbase_nodes_mem_used{node="d"} NaN',
+            '# TYPE couchbase_nodes_cmd_get counter',
+            'couchbase_nodes_cmd_get{node="a\\"b"} 7.0',
+            '',
+        ]
+
+        # Series missing from a cycle are kept until they go stale
+        exporter.publish('module1', [('nodes.mem_used', 'gauge', {'node': 'c'}, 8)], 20.0, now=10.0)
+        assert 'couchbase_nodes_mem_used{node="c"} 8.0' in exporter.text.decode('utf-8')
+        assert 'couchbase_nodes_cmd_get{node="a\\"b"} 7.0' in exporter.text.decode('utf-8')
+        exporter.publish('module1', [], 20.0, now=25.0)
+        assert exporter.text.decode('utf-8').split('\n') == [
+            '# TYPE couchbase_nodes_mem_used gauge',
+            'couchbase_nodes_mem_used{node="c"} 8.0',
+            'couchbase_nodes_mem_used{node="d"} NaN',
+            '',
+        ]
+
+        exporter.port = 0
+        exporter.start()
+        url = 'http://127.0.0.1:%d/metrics' % exporter.server.server_address[1]
+        with mock.patch('couchbase._render_prometheus') as render:
+            for _ in range(2):
+                response = six.moves.urllib.request.urlopen(url, timeout=5)
+                assert response.read() == exporter.text
+            assert not render.called
+        assert response.headers['Content-Type'] == couchbase.PROMETHEUS_CONTENT_TYPE
+    finally:
+        exporter.stop()
+        couchbase.PROMETHEUS_EXPORTERS.clear()
+
+
+def test_spool(tmpdir):
+    """
+    Check that spooled batches are bounded, replayed oldest first at a
+    limited rate, expired by age and recovered from disk after a restart
+    """
+    record = couchbase.SPOOL_RECORD_HEADER.size + 10
+    spool = couchbase.Spool(str(tmpdir.join('bounded')), 3 * record, 100, 'oldest', 2)
+    with mock.patch('couchbase.SPOOL_SEGMENT_BYTES', record):
+        for i in range(4):
+            spool.append(b'batch-%04d' % i, 10.0 + i)
+    assert (spool.pending, spool.dropped) == (3, 1)
+
+    sent = []
+    assert spool.replay(lambda body: False, 20.0) == 0
+    assert spool.replay(lambda body: sent.append(body) or True, 20.0) == 2
+    assert sent == [b'batch-0001', b'batch-0002']
+    assert spool.pending == 1 and len(os.listdir(str(tmpdir.join('bounded')))) == 1
+
+    newest = couchbase.Spool(str(tmpdir.join('newest')), 2 * record, 100, 'newest', 2)
+    assert newest.append(b'batch-0000', 0.0) and newest.append(b'batch-0001', 0.0)
+    assert not newest.append(b'batch-0002', 0.0)
+    assert newest.pending == 2 and newest.dropped == 1
+
+    # A restart recovers the segments and cuts off a partly written batch
+    with open(spool.segments[-1]['path'], 'ab') as f:
+        f.write(couchbase.SPOOL_RECORD_HEADER.pack(14.0, 10) + b'bat')
+    restarted = couchbase.Spool(str(tmpdir.join('bounded')), 3 * record, 100, 'oldest', 5)
+    assert (restarted.pending, restarted.size) == (1, record)
+    assert restarted.append(b'batch-0004', 15.0)
+    sent = []
+    assert restarted.replay(lambda body: sent.append(body) or True, 114.0) == 1
+    assert sent == [b'batch-0004'] and restarted.expired == 1 and restarted.pending == 0
+
+
+def test_spool_replay_offset_survives_restart(tmpdir):
+    """
+    Check that a restart after a partial replay neither sends the replayed
+    batches again nor counts them in the spool size
+    """
+    record = couchbase.SPOOL_RECORD_HEADER.size + 10
+    directory = str(tmpdir.join('spool'))
+    spool = couchbase.Spool(directory, 10 * record, 100, 'oldest', 2)
+    for i in range(3):
+        spool.append(b'batch-%04d' % i, 10.0 + i)
+    assert spool.replay(lambda body: True, 20.0) == 2
+    assert (spool.pending, spool.size) == (1, record)
+
+    restarted = couchbase.Spool(directory, 10 * record, 100, 'oldest', 5)
+    assert (restarted.pending, restarted.size) == (1, record)
+    sent = []
+    assert restarted.replay(lambda body: sent.append(body) or True, 20.0) == 1
+    assert sent == [b'batch-0002'] and os.listdir(directory) == []
+
+    # An offset that does not fall on a record boundary is ignored
+    restarted.append(b'batch-0003', 30.0)
+    with open(restarted.segments[0]['path'] + '.offset', 'w') as f:
+        f.write('7')
+    assert couchbase.Spool(directory, 10 * record, 100, 'oldest', 5).pending == 1
+
+
+def test_output_mode_http_spool(tmpdir):
+    """
+    Check that failed batches are spooled and replayed once the ingest
+    endpoint answers again
+    """
+    module_config = couchbase.config(_config_with(mock_config_nodes,
+                                                  ConfigOption('OutputMode', ('http',)),
+                                                  ConfigOption('IngestURL', ('http://ingest/v1/collectd',)),
+                                                  ConfigOption('SpoolDirectory', (str(tmpdir),))),
+                                     testing="yes")
+    output = module_config['output']
+    bodies = []
+    results = [False, True, True]
+    try:
+        with mock.patch('couchbase._post_batch', side_effect=lambda o, body, t: bodies.append(body) or results.pop(0)):
+            couchbase._post_metrics([couchbase.Metric('nodes.mem_used', 5, {})], module_config)
+            assert not couchbase._flush_output(module_config)
+            assert output['spool'].pending == 1
+            couchbase._post_metrics([couchbase.Metric('nodes.mem_used', 6, {})], module_config)
+            assert couchbase._flush_output(module_config)
+        assert bodies[2] == bodies[0]
+        assert output['spool'].pending == 0 and output['spool'].replayed == 1
+        assert output['batches'] == 2 and output['failures'] == 1
+    finally:
+        couchbase.INGEST_CONNECTIONS.clear()
+    with pytest.raises(ValueError):
+        couchbase.config(_config_with(mock_config_nodes, ConfigOption('SpoolDirectory', (str(tmpdir),))),
+                         testing="yes")
+
+
+def test_read_bucket_stats_counter_rates():
+    """
+    Check that CounterRates is rejected while no metric is registered as a
+    counter, and that the per-second samples of the bucket stats are sent
+    as gauges
+    """
+    for counter_rates in ('rate', 'both'):
+        with pytest.raises(ValueError):
+            couchbase.config(_config_with(mock_config_bucket, ConfigOption('CounterRates', (counter_rates,))),
+                             testing="yes")
+    module_config = couchbase.config(_config_with(mock_config_bucket, ConfigOption('CounterRates', ('raw',))),
+                                     testing="yes")
+    dispatched = []
+    with mock.patch('couchbase._api_call', mock_api_call), \
+            mock.patch('couchbase.collectd.Values') as values_class:
+        values_class.return_value.dispatch.side_effect = lambda: dispatched.append(
+            (values_class.return_value.type_instance, values_class.return_value.type,
+             values_class.return_value.values))
+        couchbase.read_bucket_stats(module_config)
+    bytes_read = [(metric_type, values[0]) for name, metric_type, values in dispatched
+                  if name == 'bucket.op.bytes_read'][0]
+    assert bytes_read[0] == 'gauge' and bytes_read[1] != int(bytes_read[1])
+
+
+def test_hot_keys_default_field_length():
+    """
+    Check that hot keys of a Module with its real dimensions and the default
+    FieldLength still get distinct plugin_instances
+    """
+    module_config = couchbase.config(_config_with(mock_config_bucket,
+                                                  ConfigOption('HotKeys', ('5',)),
+                                                  ConfigOption('FieldLength', (str(couchbase.DEFAULT_FIELD_LENGTH),))),
+                                     testing="yes")
+    dimensions = dict(module_config['dimensions'], node='10.0.0.1:8091')
+    hot_keys = [{'name': 'user::%d' % i, 'ops': float(i)} for i in range(5)]
+    hot_keys.append({'name': 'session::' + 'x' * 100, 'ops': 10.0})
+    metrics = couchbase._parse_hot_keys(hot_keys, dimensions, module_config)
+    assert len(metrics) == 5
+    plugin_instances = set(couchbase._format_dimensions(m.dimensions, module_config['field_length']) for m in metrics)
+    assert len(plugin_instances) == 5
+    for metric in metrics:
+        plugin_instance = couchbase._format_dimensions(metric.dimensions, module_config['field_length'])
+        assert len(plugin_instance) <= couchbase.DEFAULT_FIELD_LENGTH
+        assert plugin_instance.startswith('[node=10.0.0.1:8091,bucket=default,key=%s' % metric.dimensions['key'])
+
+
+def test_init_prometheus_port_in_use():
+    """
+    Check that a Prometheus port in use is logged without keeping staggered
+    Modules from being registered
+    """
+    module_config = couchbase.config(_config_with(mock_config_nodes,
+                                                  ConfigOption('PrometheusPort', ('9501',)),
+                                                  ConfigOption('StaggerStart', (True,))),
+                                     testing="yes")
+    exporter = module_config['prometheus']['exporter']
+    couchbase.DEFERRED_READS.append(module_config)
+    try:
+        with mock.patch.object(exporter, 'start', side_effect=socket.error(98, 'Address already in use')), \
+                mock.patch('couchbase.collectd.error') as error:
+            couchbase.init()
+        assert error.called
+        assert not couchbase.DEFERRED_READS
+        assert len(couchbase.STAGGER_TIMERS) == 1
+    finally:
+        couchbase.shutdown()
+        couchbase.PROMETHEUS_EXPORTERS.clear()
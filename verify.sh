@@ -1,5 +1,5 @@
 #!/bin/bash
 set -ex
 
-flake8 couchbase.py test_couchbase.py metric_info.py
+flake8 couchbase.py couchbase_collect.py test_couchbase.py metric_info.py
 py.test test_couchbase.py
\ No newline at end of file